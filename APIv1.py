@@ -3,26 +3,77 @@
 
     @author: Mar Alguacil
 """
+import os
 import json
-import pickle
+import numpy as np
 import pandas as pd
-import pmdarima
 from pathlib import Path
-from datetime import datetime
-from flask import Flask, Response
+from flask import Flask, Response, request
+from registry import ModelRegistry, DEFAULT_CITY, loadModel
+from forecast import ForecastCache, ForecastError, forecastResponse
+from predictor import ARIMAPredictor
+from metrics import instrument
 app = Flask(__name__)
+instrument(app)
 
-# Get ARIMA models from the pickle files
-path = str(Path.home())+'/.models/'
-file_hum = open(path+'arima_humidity.p', 'rb')
-model_hum  = pickle.load(file_hum)
-file_hum.close()
+def loadModels(path):
+    """
+        Gets ARIMA models from the model files.
+    """
+    return loadModel(path, 'arima_temperature'), loadModel(path, 'arima_humidity')
+
+# Models of each city ('~/.models/<city>/'), loaded when first requested
+models = ModelRegistry(str(Path.home())+'/.models/', loadModels,
+                       maxsize=int(os.environ.get('MAX_CITIES', 8)))
+
+# Look for retrained models in the background every MODELS_RELOAD_INTERVAL seconds
+reload_interval = int(os.environ.get('MODELS_RELOAD_INTERVAL', 60))
+if reload_interval > 0:
+    models.watch(reload_interval)
+
+# Maximum hours between the last observation of a pmdarima model and the
+# forecast, which needs a prediction for each hour in between (the exported
+# models jump to any hour)
+MAX_ORIGIN_GAP = int(os.environ.get('MAX_ORIGIN_GAP', 24*30))
+
+def predict(city_models, dates):
+    """
+        Predicts temperature and humidity from ARIMA models.
+      The forecasts start after the last observation of the models, so
+      the hours until the first date are skipped (models trained with a
+      random sample have no origin).
+    """
+    model_temp, model_hum = city_models
+    origin = getattr(model_temp, 'origin_', None)
+    skip = 0 if origin is None else max(int((dates[0] - origin) / pd.Timedelta(hours=1)) - 1, 0)
 
-file_temp = open(path+'arima_temperature.p', 'rb')
-model_temp = pickle.load(file_temp)
-file_temp.close()
+    return skipPredict(model_temp, skip, len(dates)), skipPredict(model_hum, skip, len(dates))
+
+def skipPredict(model, skip, n_periods):
+    """
+        Forecasts the 'n_periods' observations that follow the next
+      'skip' ones. Raises ForecastError if a pmdarima model is more than
+      MAX_ORIGIN_GAP hours old.
+    """
+    if isinstance(model, ARIMAPredictor):
+        return model.predict(n_periods=n_periods, skip=skip)
+    if skip > MAX_ORIGIN_GAP:
+        raise ForecastError("Lo siento, los modelos son demasiado antiguos para predecir las próximas horas.")
+    return np.asarray(model.predict(n_periods=skip+n_periods))[skip:]
+
+# Forecast for the next MAX_HORIZON hours of each city, computed once per hour
+INTERVALS = [24, 48, 72]
+forecasts = ForecastCache(models, predict,
+                          horizon=max(int(os.environ.get('MAX_HORIZON', 0)), max(INTERVALS)))
 
 # Define routes
+@app.errorhandler(ForecastError)
+def forecastError(error):
+    """
+        Displays the error of the models that cannot forecast.
+    """
+    return Response(str(error), status=503)
+
 @app.route("/")
 def welcome():
     """
@@ -34,30 +85,74 @@ def welcome():
             <a href='/servicio/v1/prediccion/48horas'>48</a> y \
             <a href='/servicio/v1/prediccion/72horas'>72</a> horas!"
 
+@app.route("/servicio/v1/ciudades", methods=['GET'])
+def cities():
+    """
+        Lists the cities with predictions.
+    """
+    return  Response(json.dumps(models.cities()),
+                     status=200, mimetype='application/json')
+
 @app.route("/servicio/v1/prediccion/<int:interval>horas", methods=['GET'])
 def forecast(interval):
     """
         Predicts temperature and humidity for the next 24, 48 or 72 hours.
     """
-    if interval not in [24, 48, 72]:
+    return cityForecast(DEFAULT_CITY, interval)
+
+@app.route("/servicio/v1/<city>/prediccion/<int:interval>horas", methods=['GET'])
+def cityForecast(city, interval):
+    """
+        Predicts temperature and humidity of a city for the next 24, 48 or 72 hours.
+    """
+    if interval not in INTERVALS:
         return Response("Lo siento, sólo trabajamos con predicciones para las próximas 24, 48 y 72 horas.",
                         status=400)
 
-    # Predict temperature and humidity from ARIMA models
-    forecast_temp = model_temp.predict(n_periods=interval)
-    forecast_hum  = model_hum.predict(n_periods=interval)
+    try:
+        return forecastResponse(forecasts, forecasts.get(city), last=interval)
+    except KeyError:
+        return Response("Lo siento, no hay predicciones para " + city + ".",
+                        status=404)
 
-    # Create a list with the next 'interval' hours
-    initial_hour  = (int(datetime.now().strftime('%H')) + 1)%24
-    timestamps = pd.date_range(str(initial_hour)+':00', periods=interval, freq='60min').strftime('%d/%m/%Y %H:%M')
+@app.route("/servicio/v1/prediccion", methods=['GET'])
+def forecastHours():
+    """
+        Predicts temperature and humidity for the next 'horas' hours or
+      between 'desde' and 'hasta'.
+    """
+    return cityForecastHours(DEFAULT_CITY)
+
+@app.route("/servicio/v1/<city>/prediccion", methods=['GET'])
+def cityForecastHours(city):
+    """
+        Predicts temperature and humidity of a city for the next 'horas'
+      hours or between 'desde' and 'hasta'.
+    """
+    try:
+        forecast = forecasts.get(city)
+        first, last = forecasts.hours(forecast, request.args.get('horas'),
+                                      request.args.get('desde'), request.args.get('hasta'))
+        return forecastResponse(forecasts, forecast, first, last)
+    except KeyError:
+        return Response("Lo siento, no hay predicciones para " + city + ".",
+                        status=404)
+    except ValueError as error:
+        return Response(str(error), status=400)
 
 
-    return  Response(json.dumps([{'hour': date,
-                                  'temp': round(temperature,2),
-                                  'hum' : round(humidity,2)
-                                 }
-                                 for date, temperature, humidity
-                                     in zip(timestamps, forecast_temp, forecast_hum)]),
+@app.route("/servicio/v1/prediccion/lote", methods=['POST'])
+def forecastBatch():
+    """
+        Predicts temperature and humidity for a list of queries
+      [{'ciudad', 'horas'} or {'ciudad', 'desde', 'hasta'}].
+    """
+    try:
+        response = forecasts.batch(request.get_json(force=True, silent=True), DEFAULT_CITY)
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+    return  Response(response,
                      status=200, mimetype='application/json')
 
 
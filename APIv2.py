@@ -3,24 +3,56 @@
 
     @author: Mar Alguacil
 """
+import os
 import json
-import pickle
-import pandas as pd
+import numpy as np
 from pathlib import Path
-from datetime import datetime
-from flask import Flask, Response
-from sklearn.ensemble import RandomForestRegressor
+from flask import Flask, Response, request
+from registry import ModelRegistry, DEFAULT_CITY, loadModel
+from forecast import ForecastCache, forecastResponse
+from metrics import instrument
 app = Flask(__name__)
+instrument(app)
 
-# Get RandomForestRegressor models from the pickle files
-path = str(Path.home())+'/.models/'
-file_hum = open(path+'rf_humidity.p', 'rb')
-model_hum  = pickle.load(file_hum)
-file_hum.close()
+def loadModels(path):
+    """
+        Gets RandomForestRegressor models from the model files.
+      A single multi-output model (temperature, humidity) is used if it exists.
+    """
+    try:
+        return {'temp_hum': loadModel(path, 'rf_temp_hum')}
+    except FileNotFoundError:
+        return {'temp': loadModel(path, 'rf_temperature'),
+                'hum' : loadModel(path, 'rf_humidity')}
+
+# Models of each city ('~/.models/<city>/'), loaded when first requested
+models = ModelRegistry(str(Path.home())+'/.models/', loadModels,
+                       maxsize=int(os.environ.get('MAX_CITIES', 8)))
+
+# Look for retrained models in the background every MODELS_RELOAD_INTERVAL seconds
+reload_interval = int(os.environ.get('MODELS_RELOAD_INTERVAL', 60))
+if reload_interval > 0:
+    models.watch(reload_interval)
+
+def predict(city_models, dates):
+    """
+        Predicts temperature and humidity from RandomForestRegressor models.
+    """
+    # [(year, month, day, hour)]
+    X = np.column_stack((dates.year, dates.month, dates.day, dates.hour))
+
+    if 'temp_hum' in city_models:
+        forecast_temp, forecast_hum = city_models['temp_hum'].predict(X).T
+    else:
+        forecast_temp = city_models['temp'].predict(X)
+        forecast_hum  = city_models['hum'].predict(X)
 
-file_temp = open(path+'rf_temperature.p', 'rb')
-model_temp = pickle.load(file_temp)
-file_temp.close()
+    return forecast_temp, forecast_hum
+
+# Forecast for the next MAX_HORIZON hours of each city, computed once per hour
+INTERVALS = [24, 48, 72]
+forecasts = ForecastCache(models, predict,
+                          horizon=max(int(os.environ.get('MAX_HORIZON', 0)), max(INTERVALS)))
 
 # Define routes
 @app.route("/")
@@ -34,33 +66,74 @@ def welcome():
             <a href='/servicio/v2/prediccion/48horas'>48</a> y \
             <a href='/servicio/v2/prediccion/72horas'>72</a> horas!"
 
+@app.route("/servicio/v2/ciudades", methods=['GET'])
+def cities():
+    """
+        Lists the cities with predictions.
+    """
+    return  Response(json.dumps(models.cities()),
+                     status=200, mimetype='application/json')
+
 @app.route("/servicio/v2/prediccion/<int:interval>horas", methods=['GET'])
 def forecast(interval):
     """
         Predicts temperature and humidity for the next 24, 48 or 72 hours.
     """
-    if interval not in [24, 48, 72]:
+    return cityForecast(DEFAULT_CITY, interval)
+
+@app.route("/servicio/v2/<city>/prediccion/<int:interval>horas", methods=['GET'])
+def cityForecast(city, interval):
+    """
+        Predicts temperature and humidity of a city for the next 24, 48 or 72 hours.
+    """
+    if interval not in INTERVALS:
         return Response("Lo siento, sólo trabajamos con predicciones para las próximas 24, 48 y 72 horas.",
                         status=400)
 
-    # Create a list with the next 'interval' hours
-    initial_hour  = (int(datetime.now().strftime('%H')) + 1)%24
-    timestamps = pd.date_range(str(initial_hour)+':00', periods=interval, freq='60min').strftime('%d/%m/%Y %H:%M')
+    try:
+        return forecastResponse(forecasts, forecasts.get(city), last=interval)
+    except KeyError:
+        return Response("Lo siento, no hay predicciones para " + city + ".",
+                        status=404)
 
-    # [(year, month, day, hour)]
-    X = [(datetime[6:10], datetime[3:5], datetime[:2], datetime[11:13])
-              for datetime in timestamps]
-
-    # Predict temperature and humidity from RandomForestRegressor models
-    forecast_temp = model_temp.predict(X)
-    forecast_hum  = model_hum.predict(X)
-
-    return  Response(json.dumps([{'hour': date,
-                                  'temp': round(temperature,2),
-                                  'hum' : round(humidity,2)
-                                 }
-                                 for date, temperature, humidity
-                                     in zip(timestamps, forecast_temp, forecast_hum)]),
+@app.route("/servicio/v2/prediccion", methods=['GET'])
+def forecastHours():
+    """
+        Predicts temperature and humidity for the next 'horas' hours or
+      between 'desde' and 'hasta'.
+    """
+    return cityForecastHours(DEFAULT_CITY)
+
+@app.route("/servicio/v2/<city>/prediccion", methods=['GET'])
+def cityForecastHours(city):
+    """
+        Predicts temperature and humidity of a city for the next 'horas'
+      hours or between 'desde' and 'hasta'.
+    """
+    try:
+        forecast = forecasts.get(city)
+        first, last = forecasts.hours(forecast, request.args.get('horas'),
+                                      request.args.get('desde'), request.args.get('hasta'))
+        return forecastResponse(forecasts, forecast, first, last)
+    except KeyError:
+        return Response("Lo siento, no hay predicciones para " + city + ".",
+                        status=404)
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+
+@app.route("/servicio/v2/prediccion/lote", methods=['POST'])
+def forecastBatch():
+    """
+        Predicts temperature and humidity for a list of queries
+      [{'ciudad', 'horas'} or {'ciudad', 'desde', 'hasta'}].
+    """
+    try:
+        response = forecasts.batch(request.get_json(force=True, silent=True), DEFAULT_CITY)
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+    return  Response(response,
                      status=200, mimetype='application/json')
 
 
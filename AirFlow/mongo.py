@@ -0,0 +1,132 @@
+"""
+    Shared MongoDB connection of the workflow tasks.
+
+    A single client (with its connection pool) is created per process the
+    first time it is needed and reused by every function of utils.py.
+
+    Environment variables:
+      - MONGO_URI           - connection string (mongodb://localhost:27017
+                              by default).
+      - MONGO_DATABASE      - database name ('database' by default).
+      - MONGO_MAX_POOL_SIZE - maximum number of connections of the pool.
+      - MONGO_MIN_POOL_SIZE - connections kept open in the pool.
+      - MONGO_TIMEOUT_MS    - server selection, connection and socket
+                              timeouts in milliseconds.
+
+    @author: Mar Alguacil
+"""
+import os
+from pymongo import MongoClient, ReplaceOne, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
+MONGO_DATABASE = os.environ.get('MONGO_DATABASE', 'database')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 10))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 30000))
+
+# Documents sent to the server in each bulk write
+BATCH_SIZE = 1000
+
+_client = None
+
+
+def getClient():
+    """
+        Returns the MongoDB client of the process, connecting if needed.
+    """
+    global _client
+    if _client is None:
+        _client = MongoClient(MONGO_URI,
+                              maxPoolSize=MONGO_MAX_POOL_SIZE,
+                              minPoolSize=MONGO_MIN_POOL_SIZE,
+                              serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                              connectTimeoutMS=MONGO_TIMEOUT_MS,
+                              socketTimeoutMS=MONGO_TIMEOUT_MS)
+    return _client
+
+
+def closeClient():
+    """
+        Closes the MongoDB client of the process.
+    """
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def resetClient():
+    """
+        Forgets the client inherited from the parent process, whose
+      connections must not be shared with a forked process.
+    """
+    global _client
+    _client = None
+
+os.register_at_fork(after_in_child=resetClient)
+
+
+def getCollection(name):
+    """
+        Returns a collection of the workflow database.
+    """
+    return getClient()[MONGO_DATABASE][name]
+
+
+def uniqueIndex(collection, keys):
+    """
+        Creates a unique index, removing the duplicated documents
+      (keeping the first one) stored before it existed.
+    """
+    keys = [(key, ASCENDING) for key in keys]
+    try:
+        collection.create_index(keys, unique=True)
+    except OperationFailure:
+        duplicates = collection.aggregate([{'$group': {'_id': {key: '$'+key for key, _ in keys},
+                                                       'ids': {'$push': '$_id'},
+                                                       'count': {'$sum': 1}}},
+                                           {'$match': {'count': {'$gt': 1}}}],
+                                          allowDiskUse=True)
+        for duplicate in duplicates:
+            collection.delete_many({'_id': {'$in': duplicate['ids'][1:]}})
+
+        # An index with the same keys but not unique may exist
+        for index in list(collection.list_indexes()):
+            if list(index['key'].items()) == keys and not index.get('unique'):
+                collection.drop_index(index['name'])
+        collection.create_index(keys, unique=True)
+
+
+def insertMany(collection, documents, batch_size=BATCH_SIZE):
+    """
+        Inserts documents in unordered batches, so the server applies
+      each batch in any order and one failed document does not stop the
+      rest. Duplicated documents (unique index) are skipped.
+    """
+    for start in range(0, len(documents), batch_size):
+        try:
+            collection.insert_many(documents[start:start+batch_size], ordered=False)
+        except BulkWriteError as error:
+            # 11000: duplicate key
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                raise
+
+
+def upsertMany(collection, documents, keys, batch_size=BATCH_SIZE):
+    """
+        Replaces the documents with the same 'keys' fields, or inserts
+      them, in unordered batches.
+    """
+    for start in range(0, len(documents), batch_size):
+        collection.bulk_write([ReplaceOne({key: document[key] for key in keys}, document, upsert=True)
+                               for document in documents[start:start+batch_size]],
+                              ordered=False)
+
+
+def bulkWrite(collection, operations, batch_size=BATCH_SIZE):
+    """
+        Applies write operations in unordered batches.
+    """
+    for start in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[start:start+batch_size], ordered=False)
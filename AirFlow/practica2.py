@@ -11,6 +11,12 @@ from shutil import rmtree
 # Airflow variable
 path_workflow = Variable.get ("path_workflow")
 
+# Data sources (URLs or local files, e.g. to work offline) and their cache,
+# which is kept between runs
+humidity_source    = Variable.get("humidity_source", default_var=DATA_URL+'humidity.csv.zip')
+temperature_source = Variable.get("temperature_source", default_var=DATA_URL+'temperature.csv.zip')
+data_cache = str(Path.home())+'/.cache/forecast/'
+
 # Default Arguments that we can use when creating tasks
 # These args will get passed on to each operator
 default_args = {
@@ -47,60 +53,89 @@ PrepareEnviroment = BashOperator(task_id='PrepareEnviroment',
 #######################################################################
 #                                                                     #
 # EXTRACT DATA                                                        #
-#   1) Download the data from the Manu Parra's repository.            #
-#   2) Unzip data.                                                    #
+#   1) Download the data from the Manu Parra's repository (or copy    #
+#   the local files), only if it has changed since the last run.      #
+#   2) Keep the zip archives in the data cache; they are read         #
+#   without unzipping them.                                           #
 #                                                                     #
 #######################################################################
-GetDataA = BashOperator( task_id='GetDataHumidity',
-                         depends_on_past=False,
-                         bash_command='wget --output-document={{var.value.path_workflow}}/humidity.csv.zip \
-                         https://raw.githubusercontent.com/manuparra/MaterialCC2020/master/humidity.csv.zip && \
-                         unzip {{var.value.path_workflow}}/humidity.csv.zip -d {{var.value.path_workflow}}',
-                         dag=dag
-                       )
+GetDataA = PythonOperator( task_id='GetDataHumidity',
+                           python_callable=getData,
+                           op_kwargs={
+                               'source' : humidity_source,
+                               'cache'  : data_cache
+                           },
+                           dag=dag
+                         )
 
-GetDataB = BashOperator( task_id='GettDataTemperature',
-                          depends_on_past=False,
-                          bash_command= 'wget --output-document={{var.value.path_workflow}}/temperature.csv.zip \
-                          https://raw.githubusercontent.com/manuparra/MaterialCC2020/master/temperature.csv.zip && \
-                          unzip {{var.value.path_workflow}}/temperature.csv.zip -d {{var.value.path_workflow}}',
-                          dag=dag
-                        )
+GetDataB = PythonOperator( task_id='GettDataTemperature',
+                           python_callable=getData,
+                           op_kwargs={
+                               'source' : temperature_source,
+                               'cache'  : data_cache
+                           },
+                           dag=dag
+                         )
 
 #######################################################################
 #                                                                     #
 # PROCESS DATA                                                        #
-#   1) Extract DATETIME and SAN FRANCISCO columns from humidity.csv   #
-#   and temperature.csv.                                              #
+#   1) Extract DATETIME and city columns from humidity.csv and        #
+#   temperature.csv (read from the cached zip archives).              #
 #   2) Create a new dataset with the following columns:               #
 #       - DATE - intersection of the DATETIME columns from two both   #
 #   datasets.                                                         #
-#       - TEMP - SAN FRANCISCO column from temperature.csv.           #
-#       - HUM  - SAN FRANCISCO column from humidity.csv.              #
-#   3) Store the new dataset in MongoDB.                              #
+#       - CITY - city key (e.g. 'san_francisco').                     #
+#       - TEMP - city column from temperature.csv.                    #
+#       - HUM  - city column from humidity.csv.                       #
+#   3) Store the rows newer than the previous run in MongoDB.         #
 #                                                                     #
 #######################################################################
 ProcessData = PythonOperator( task_id='ProcessData',
                               python_callable=mergeDataSets,
                               op_kwargs={
-                                  'hum_file'   : '{{var.value.path_workflow}}/humidity.csv',
-                                  'temp_file'  : '{{var.value.path_workflow}}/temperature.csv'
+                                  'hum_file'   : "{{ ti.xcom_pull(task_ids='GetDataHumidity') }}",
+                                  'temp_file'  : "{{ ti.xcom_pull(task_ids='GettDataTemperature') }}",
+                                  'chunksize'  : 10000,
+                                  'incremental': True
                               },
                               dag=dag
                             )
 
 #######################################################################
 #                                                                     #
-# CREATE ARIMA MODEL                                                  #
+# CACHE DATA                                                          #
 #   1) Extract dataset from MongoDB.                                  #
-#   2) Train with the humidity and temperature sets.                  #
-#   3) Stores the ARIMA models in picke files.                        #
+#   2) Store each column (DATE, TEMP, HUM) in a NumPy file that the   #
+#   training tasks can memory-map.                                    #
+#                                                                     #
+#######################################################################
+CacheData = PythonOperator( task_id='CacheData',
+                            python_callable=cacheDataSet,
+                            op_kwargs={
+                                'cache' : '{{var.value.path_workflow}}/cache'
+                            },
+                            dag=dag
+                          )
+
+#######################################################################
+#                                                                     #
+# CREATE ARIMA MODEL                                                  #
+#   1) Extract dataset from the local cache.                          #
+#   2) Train with the last 90 days of humidity and temperature of     #
+#   each city, in time order, or update the stored models with the    #
+#   rows newer than the last run.                                     #
+#   3) Stores the ARIMA models with joblib.                           #
 #                                                                     #
 #######################################################################
 TrainARIMA = PythonOperator( task_id='TrainARIMA',
                              python_callable=trainARIMA,
                              op_kwargs={
-                                 'path' : str(Path.home())+'/.models/'
+                                 'path'   : str(Path.home())+'/.models/',
+                                 'cache'  : '{{var.value.path_workflow}}/cache',
+                                 'n_jobs' : 2,
+                                 'window' : 24*90,
+                                 'incremental' : True
                              },
                              dag=dag
                            )
@@ -108,15 +143,19 @@ TrainARIMA = PythonOperator( task_id='TrainARIMA',
 #######################################################################
 #                                                                     #
 # CREATE RANDOM FOREST MODEL                                          #
-#   1) Extract dataset from MongoDB.                                  #
-#   2) Train with the humidity and temperature sets.                  #
-#   3) Stores the Random Forest models with pickle.                   #
+#   1) Extract dataset from the local cache.                          #
+#   2) Train with the humidity and temperature sets of each city, or  #
+#   add trees trained with the rows newer than the last run.          #
+#   3) Stores the Random Forest models with joblib.                   #
 #                                                                     #
 #######################################################################
 TrainRF = PythonOperator( task_id='TrainRF',
                           python_callable=trainRandomForest,
                           op_kwargs={
-                              'path' : str(Path.home())+'/.models/'
+                              'path'        : str(Path.home())+'/.models/',
+                              'multioutput' : True,
+                              'cache'       : '{{var.value.path_workflow}}/cache',
+                              'incremental' : True
                           },
                           dag=dag
                         )
@@ -181,7 +220,7 @@ DeployAPIv2 = BashOperator( task_id='DeployAPIv2',
 #######################################################################
 #                                                                     #
 # CLEAN UP                                                            #
-#   1) Remove 'path_workflow' folder.                                 #
+#   1) Remove 'path_workflow' folder (the data cache is kept).        #
 #                                                                     #
 #######################################################################
 CleanUp = PythonOperator( task_id='CleanUp',
@@ -194,7 +233,7 @@ CleanUp = PythonOperator( task_id='CleanUp',
 
 
 # Setting up Dependencies
-PrepareEnviroment >> [GetDataA, GetDataB] >> ProcessData >> [TrainARIMA,TrainRF] >> CloneRepo >> [RunUnitTestsV1, RunUnitTestsV2]
+PrepareEnviroment >> [GetDataA, GetDataB] >> ProcessData >> CacheData >> [TrainARIMA,TrainRF] >> CloneRepo >> [RunUnitTestsV1, RunUnitTestsV2]
 
 RunUnitTestsV1.set_downstream(DeployAPIv1)
 RunUnitTestsV2.set_downstream(DeployAPIv2)
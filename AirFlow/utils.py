@@ -1,155 +1,1041 @@
 import os
-import pickle
+import json
+import time
+import joblib
+import hashlib
+import zipfile
+import urllib.request
+import numpy as np
 import pandas as pd
 import pmdarima as pm
 from pathlib import Path
+from datetime import datetime
 from shutil  import rmtree
-from pymongo import MongoClient
+from functools import wraps
+from contextlib import contextmanager
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import UpdateOne
+from mongo import getCollection, uniqueIndex, insertMany, upsertMany, bulkWrite
 from sklearn.ensemble import RandomForestRegressor
 
 
+#######################################################################
+#                                                                     #
+# METRICS                                                             #
+#   Duration and number of rows processed by each step, printed in    #
+#   the task log and, if METRICS_DIR is set, written in the           #
+#   Prometheus text format ('METRICS_DIR/<step>.prom') for the        #
+#   textfile collector of node_exporter.                              #
+#                                                                     #
+#######################################################################
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+def recordMetrics(step, seconds, rows):
+    """
+        Records the duration and the number of rows of a step.
+    """
+    print(step + ': ' + str(rows) + ' rows in ' + '%.3f' % seconds + ' s')
+    if not METRICS_DIR:
+        return
+
+    labels = '{step="' + step + '"}'
+    filename = os.path.join(METRICS_DIR, step+'.prom')
+    Path(METRICS_DIR).mkdir(parents=True, exist_ok=True)
+    with open(filename+'.tmp', 'w') as metrics:
+        metrics.write('# TYPE airflow_step_duration_seconds gauge\n'
+                      'airflow_step_duration_seconds' + labels + ' ' + repr(seconds) + '\n'
+                      '# TYPE airflow_step_rows gauge\n'
+                      'airflow_step_rows' + labels + ' ' + str(rows) + '\n'
+                      '# TYPE airflow_step_last_success_timestamp_seconds gauge\n'
+                      'airflow_step_last_success_timestamp_seconds' + labels + ' ' + repr(time.time()) + '\n')
+    os.replace(filename+'.tmp', filename)
+
+
+def timed(step):
+    """
+        Decorator that records the duration of a step and the number
+      of rows it processed (returned by the step).
+    """
+    def decorator(function):
+        @wraps(function)
+        def timedStep(*args, **kwargs):
+            start = time.perf_counter()
+            rows = function(*args, **kwargs)
+            recordMetrics(step, time.perf_counter() - start, rows)
+            return rows
+        return timedStep
+    return decorator
+
+
+#######################################################################
+#                                                                     #
+# EXTRACT DATA                                                        #
+#   1) Download an archive (or read a local file) only if it has      #
+#   changed since the previous run (ETag / checksum).                 #
+#   2) Keep it in a content-addressed cache ('<cache>/<sha256>.zip')  #
+#   outside the workflow folder, so it survives the clean-up.         #
+#   The CSV files are read straight from the archives.                #
+#                                                                     #
+#######################################################################
+DATA_URL = 'https://raw.githubusercontent.com/manuparra/MaterialCC2020/master/'
+
+def storeStream(stream, cache, suffix):
+    """
+        Copies a stream to the cache, named by the SHA-256 of its content.
+      Returns the checksum.
+    """
+    checksum = hashlib.sha256()
+    tmp_file = os.path.join(cache, 'download.' + str(os.getpid()) + '.tmp')
+    with open(tmp_file, 'wb') as output:
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            checksum.update(block)
+            output.write(block)
+    os.replace(tmp_file, os.path.join(cache, checksum.hexdigest() + suffix))
+
+    return checksum.hexdigest()
+
+
+def getData(source, cache, timeout=60):
+    """
+        Returns the path of the cached copy of an archive ('source' is a
+      URL or a local file), which is only downloaded (copied) again if
+      it has changed: the server is asked with the ETag/Last-Modified
+      of the cached copy and local files are compared by size and
+      modification time. Without connection, the cached copy is used.
+    """
+    Path(cache).mkdir(parents=True, exist_ok=True)
+    suffix = ''.join(Path(source).suffixes[-1:])
+
+    # Cached copy of the source: <cache>/<sha1 of the source>.json
+    entry_file = os.path.join(cache, hashlib.sha1(source.encode()).hexdigest() + '.json')
+    entry = {}
+    if os.path.exists(entry_file):
+        with open(entry_file) as entry_json:
+            entry = json.load(entry_json)
+    cached = os.path.join(cache, entry.get('sha256', '') + suffix)
+    if not os.path.exists(cached):
+        entry = {}
+
+    if '://' not in source or source.startswith('file://'):
+        local_file = source[len('file://'):] if source.startswith('file://') else source
+        stat = os.stat(local_file)
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+            return cached
+        with open(local_file, 'rb') as stream:
+            new_entry = {'sha256': storeStream(stream, cache, suffix),
+                         'size'  : stat.st_size, 'mtime': stat.st_mtime_ns}
+    else:
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            with urllib.request.urlopen(urllib.request.Request(source, headers=headers),
+                                        timeout=timeout) as response:
+                new_entry = {'sha256'        : storeStream(response, cache, suffix),
+                             'etag'          : response.headers.get('ETag'),
+                             'last_modified' : response.headers.get('Last-Modified')}
+        except HTTPError as error:
+            if error.code == 304 and entry:
+                return cached
+            raise
+        except URLError:
+            if entry:
+                print('Cannot download ' + source + ', using the cached copy')
+                return cached
+            raise
+
+    with open(entry_file+'.tmp', 'w') as entry_json:
+        json.dump(new_entry, entry_json)
+    os.replace(entry_file+'.tmp', entry_file)
+
+    # Remove the previous copy unless it has the same content
+    if entry and entry['sha256'] != new_entry['sha256']:
+        os.remove(cached)
+
+    return os.path.join(cache, new_entry['sha256'] + suffix)
+
+
+@contextmanager
+def openCSV(csvfile):
+    """
+        Opens a CSV file, or the CSV file of a zip archive without
+      extracting it.
+    """
+    if not zipfile.is_zipfile(csvfile):
+        with open(csvfile, 'rb') as csv:
+            yield csv
+        return
+
+    with zipfile.ZipFile(csvfile) as archive:
+        name = next(name for name in archive.namelist()
+                    if name.endswith('.csv') and not name.startswith('__MACOSX'))
+        with archive.open(name) as csv:
+            yield csv
+
+
 #######################################################################
 #                                                                     #
 # PROCESS DATA                                                        #
-#   1) Extract DATETIME and SAN FRANCISCO columns from humidity.csv   #
-#   and temperature.csv.                                              #
+#   1) Extract DATETIME and city columns from humidity.csv and        #
+#   temperature.csv.                                                  #
 #   2) Create a new dataset with the following columns:               #
 #       - DATE - intersection of the DATETIME columns from two both   #
 #   datasets.                                                         #
-#       - TEMP - SAN FRANCISCO column from temperature.csv.           #
-#       - HUM  - SAN FRANCISCO column from humidity.csv.              #
-#   3) Store the new dataset in MongoDB.                              #
+#       - CITY - city key (e.g. 'san_francisco').                     #
+#       - TEMP - city column from temperature.csv.                    #
+#       - HUM  - city column from humidity.csv.                       #
+#   3) Store the new dataset in MongoDB, one document per city/day:   #
+#       {'city': CITY, 'day': DAY,                                    #
+#        'hour': [...], 'temp': [...], 'hum': [...]}                  #
 #                                                                     #
 #######################################################################
-def selectCSVcolumns(csvfile, column_name):
+# City used by default (e.g. by the routes without a city of the APIs)
+DEFAULT_CITY = 'san_francisco'
+
+def cityKey(city):
+    """
+        Converts a city column name into the key used in the database,
+      the model folders and the URLs (e.g. 'San Francisco' -> 'san_francisco').
+    """
+    return city.strip().lower().replace(' ', '_')
+
+
+def selectCities(hum_file, temp_file):
+    """
+        Returns the city columns that appear in both CSV files.
+    """
+    with openCSV(hum_file) as csv:
+        columnsA = pd.read_csv(csv, nrows=0).columns
+    with openCSV(temp_file) as csv:
+        columnsB = pd.read_csv(csv, nrows=0).columns
+    return [city for city in columnsB if city in columnsA and city != 'datetime']
+
+
+def toLongFormat(data, column_name):
+    """
+        Converts a (datetime, city columns...) table into
+      (DATE, CITY, column_name) rows.
+    """
+    data = data.rename(columns=lambda column: 'DATE' if column == 'datetime' else cityKey(column))
+    return data.melt(id_vars='DATE', var_name='CITY', value_name=column_name)
+
+
+def selectCSVcolumns(csvfile, column_name, cities):
     """
         Extracts specific columns from a CSV file.
     """
-    data = pd.read_csv(csvfile, usecols=['datetime','San Francisco'])
-    return data.rename(columns={'datetime':'DATE', 'San Francisco': column_name})
+    with openCSV(csvfile) as csv:
+        data = pd.read_csv(csv, usecols=['datetime']+cities)
+    return toLongFormat(data, column_name)
 
 
-def mergeDataSets(hum_file, temp_file):
+def readCSVchunks(csvfile, column_name, cities, chunksize):
+    """
+        Extracts specific columns from a CSV file in chunks of
+      'chunksize' rows, parsing the datetime column.
+    """
+    with openCSV(csvfile) as csv:
+        for chunk in pd.read_csv(csv, usecols=['datetime']+cities,
+                                 dtype={city: 'float64' for city in cities},
+                                 parse_dates=['datetime'],
+                                 chunksize=chunksize):
+            yield toLongFormat(chunk, column_name)
+
+
+def mergeCSVchunks(hum_file, temp_file, cities, chunksize):
+    """
+        Merges two CSV files sorted by datetime chunk by chunk.
+      Rows are only kept in memory until the other file has been
+      read up to the same date.
+    """
+    readers = [readCSVchunks(temp_file, 'TEMP', cities, chunksize),
+               readCSVchunks(hum_file, 'HUM', cities, chunksize)]
+    pending = [None, None]
+    last_date = [None, None]
+
+    while readers[0] is not None or readers[1] is not None:
+        # Read the next chunk of each file
+        for i, reader in enumerate(readers):
+            if reader is None:
+                continue
+            chunk = next(reader, None)
+            if chunk is None:
+                readers[i] = None
+                last_date[i] = pd.Timestamp.max
+            else:
+                pending[i] = chunk if pending[i] is None else pd.concat([pending[i], chunk])
+                last_date[i] = chunk['DATE'].max()
+
+        if pending[0] is None or pending[1] is None:
+            if None in readers:
+                return # One of the files is empty
+            continue
+
+        # Rows up to the last date read from both files can be merged
+        limit = min(last_date)
+        ready = [data[data['DATE'] <= limit] for data in pending]
+        pending = [data[data['DATE'] > limit] for data in pending]
+
+        yield ready[0].merge(ready[1], on=['DATE', 'CITY']).dropna()
+
+
+def toBuckets(data):
+    """
+        Groups the dataset into one document per city and day with
+      compact array fields.
+    """
+    days = data['DATE'].dt.floor('D')
+    return [{'city' : city,
+             'day'  : day.to_pydatetime(),
+             'hour' : group['DATE'].dt.hour.tolist(),
+             'temp' : group['TEMP'].tolist(),
+             'hum'  : group['HUM'].tolist()}
+            for (city, day), group in data.groupby(['CITY', days])]
+
+
+def fromBuckets(buckets):
+    """
+        Builds the dataset (DATE, TEMP, HUM) from daily documents.
+    """
+    buckets = list(buckets)
+    if not buckets:
+        return pd.DataFrame({'DATE': pd.Series(dtype='datetime64[ns]'),
+                             'TEMP': pd.Series(dtype='float64'),
+                             'HUM' : pd.Series(dtype='float64')})
+
+    sizes = [len(bucket['hour']) for bucket in buckets]
+    days  = np.repeat(np.array([bucket['day'] for bucket in buckets], dtype='datetime64[h]'), sizes)
+    hours = np.concatenate([bucket['hour'] for bucket in buckets]).astype('timedelta64[h]')
+
+    return pd.DataFrame({'DATE': days + hours,
+                         'TEMP': np.concatenate([bucket['temp'] for bucket in buckets]),
+                         'HUM' : np.concatenate([bucket['hum'] for bucket in buckets])})
+
+
+# Fields of the documents read by the training tasks
+BUCKET_FIELDS = {'_id': False, 'day': True, 'hour': True, 'temp': True, 'hum': True}
+
+def storeBuckets(hum_temp, data, mode='upsert'):
+    """
+        Stores the dataset in MongoDB, one document per city and day:
+          - 'insert' - inserts the documents (empty collection).
+          - 'upsert' - replaces the stored documents of the same days,
+                       so storing the dataset again does not duplicate it.
+          - 'append' - appends the rows to the stored documents of
+                       their days, skipping the hours already stored,
+                       so appending the dataset again does not duplicate it.
+        Returns the number of rows stored.
+    """
+    if not len(data):
+        return 0
+
+    buckets = toBuckets(data)
+    if mode == 'append':
+        # Last hour stored of each day
+        stored = hum_temp.find({'city': {'$in': list({bucket['city'] for bucket in buckets})},
+                                'day' : {'$in': list({bucket['day'] for bucket in buckets})}},
+                               {'_id': False, 'city': True, 'day': True, 'hour': {'$slice': -1}})
+        last_hours = {(bucket['city'], bucket['day']): bucket['hour'][-1]
+                      for bucket in stored if bucket['hour']}
+
+        operations, rows = [], 0
+        for bucket in buckets:
+            last_hour = last_hours.get((bucket['city'], bucket['day']), -1)
+            new = int(np.searchsorted(bucket['hour'], last_hour, 'right'))
+            if new == len(bucket['hour']):
+                continue
+            rows += len(bucket['hour']) - new
+
+            # The rows are only appended if no later hour has been stored since
+            query = {'city': bucket['city'], 'day': bucket['day']}
+            if last_hour >= 0:
+                query['hour'] = {'$not': {'$gte': bucket['hour'][new]}}
+            operations.append(UpdateOne(query,
+                                        {'$push': {'hour': {'$each': bucket['hour'][new:]},
+                                                   'temp': {'$each': bucket['temp'][new:]},
+                                                   'hum' : {'$each': bucket['hum'][new:]}}},
+                                        upsert=last_hour < 0))
+        bulkWrite(hum_temp, operations)
+        return rows
+
+    if mode == 'insert':
+        insertMany(hum_temp, buckets)
+    else:
+        upsertMany(hum_temp, buckets, ['city', 'day'])
+
+    return len(data)
+
+
+@timed('ingest')
+def mergeDataSets(hum_file, temp_file, chunksize=None, cities=None, incremental=False):
     """
         Merges datasets with a common datetime column and
-      stores the new dataset in MongoDB.
+      stores the new dataset in MongoDB. The CSV files may be
+      zip archives, which are read without extracting them.
+        If 'chunksize' is given, the CSV files are streamed and the
+      data is stored in batches of at most 'chunksize' rows.
+        Only the given city columns are stored ('cities'), or every
+      city in both files by default.
+        If 'incremental' is set, only the rows newer than the last
+      stored row (high-water mark) are stored. Otherwise, the stored
+      days are replaced. The high-water mark advances with each batch
+      stored, so a failed run can be repeated.
+        Returns the number of rows stored.
     """
-    dataA = selectCSVcolumns(hum_file, 'HUM')
-    dataB = selectCSVcolumns(temp_file, 'TEMP')
-    data = dataB.merge(dataA, on='DATE')
-    data = data.dropna()
+    if cities is None:
+        cities = selectCities(hum_file, temp_file)
 
-    # Connect to MongoDB
-    client = MongoClient('localhost', 27017)
+    last_date = getHighWaterMark('ingest') if incremental else None
 
-    # Get hum_temp collection of the database
-    hum_temp = client.database.hum_temp
+    def newRows(data):
+        return data if last_date is None else data[data['DATE'] > last_date]
 
-    # Store the data in the database
-    hum_temp.insert_one({'index' : 'Humidity-Temperature',
-                         'data' : data.to_dict('records')})
+    # Get hum_temp_days collection of the database (one document per city and day)
+    hum_temp = getCollection('hum_temp_days')
+    uniqueIndex(hum_temp, ['city', 'day'])
 
-    client.close()
+    # The first time, the documents are just inserted
+    if incremental:
+        mode = 'append'
+    else:
+        mode = 'insert' if hum_temp.find_one({}, {'_id': True}) is None else 'upsert'
+
+    stored_date, rows = None, 0
+    if chunksize:
+        # Store the data in the database batch by batch
+        #  -> The last day of each batch may be incomplete, so it is
+        #     stored with the next one
+        last_day = None
+        for data in mergeCSVchunks(hum_file, temp_file, cities, chunksize):
+            data = newRows(data)
+            if last_day is not None:
+                data = pd.concat([last_day, data])
+            if not len(data):
+                continue
+            complete = data['DATE'] < data['DATE'].max().floor('D')
+            rows += storeBuckets(hum_temp, data[complete], mode)
+            last_day = data[~complete]
+            if complete.any():
+                setHighWaterMark('ingest', data.loc[complete, 'DATE'].max())
+
+        if last_day is not None and len(last_day):
+            rows += storeBuckets(hum_temp, last_day, mode)
+            stored_date = last_day['DATE'].max()
+    else:
+        dataA = selectCSVcolumns(hum_file, 'HUM', cities)
+        dataB = selectCSVcolumns(temp_file, 'TEMP', cities)
+        data = dataB.merge(dataA, on=['DATE', 'CITY'])
+        data = data.dropna()
+        data['DATE'] = pd.to_datetime(data['DATE'])
+        data = newRows(data)
+
+        # Store the data in the database
+        rows = storeBuckets(hum_temp, data, mode)
+        if len(data):
+            stored_date = data['DATE'].max()
+
+    if stored_date is not None:
+        setHighWaterMark('ingest', stored_date)
+
+    return rows
+
+
+def listCities(cache=None):
+    """
+        Returns the keys of the cities stored in MongoDB (or in the
+      local cache, if given).
+    """
+    if cache is not None:
+        return sorted(city.name for city in Path(cache).iterdir() if city.is_dir())
+
+    # Get hum_temp_days collection of the database
+    return sorted(getCollection('hum_temp_days').distinct('city'))
+
+
+def loadDataSet(start=None, end=None, cache=None, city=DEFAULT_CITY, batch_size=100):
+    """
+        Extracts the dataset of a city from MongoDB, reading only the
+      days between 'start' and 'end' (both included) if given.
+        If 'cache' is given, the dataset is read from the local
+      columnar cache instead (see cacheDataSet).
+    """
+    start = None if start is None else pd.Timestamp(start)
+    end   = None if end is None else pd.Timestamp(end)
+
+    if cache is not None:
+        return readCache(cache, start, end, city)
+
+    query = {'city': city}
+    if start is not None:
+        query.setdefault('day', {})['$gte'] = start.floor('D').to_pydatetime()
+    if end is not None:
+        query.setdefault('day', {})['$lte'] = end.to_pydatetime()
+
+    # Get hum_temp_days collection of the database
+    hum_temp = getCollection('hum_temp_days')
+
+    # Extract the data from the database
+    cursor = hum_temp.find(query, BUCKET_FIELDS,
+                           batch_size=batch_size).sort('day', 1)
+    data = fromBuckets(cursor)
+
+    # Trim the first and last days
+    if start is not None:
+        data = data[data['DATE'] >= start]
+    if end is not None:
+        data = data[data['DATE'] <= end]
+
+    return data.reset_index(drop=True)
 
 
 #######################################################################
 #                                                                     #
-# CREATE ARIMA MODEL                                                  #
+# CACHE DATA                                                          #
 #   1) Extract dataset from MongoDB.                                  #
-#   2) Train with the humidity and temperature sets.                  #
-#   3) Stores the ARIMA models in pickle files.                       #
+#   2) Store each column (DATE, TEMP, HUM) in a NumPy file that the   #
+#   training tasks can memory-map.                                    #
 #                                                                     #
 #######################################################################
-def trainARIMA(path):
+CACHE_COLUMNS = {'DATE': 'datetime64[s]', 'TEMP': 'float64', 'HUM': 'float64'}
+
+@timed('cache')
+def cacheDataSet(cache, cities=None, batch_size=100):
     """
-        Creates ARIMA models (Humidity - Temperature).
+        Writes the dataset stored in MongoDB to a local columnar
+      cache: one NumPy file per column in the 'cache/<city>' folders.
+      Returns the number of rows written.
     """
-    # Connect to MongoDB
-    client = MongoClient('localhost', 27017)
+    if cities is None:
+        cities = listCities()
 
-    # Get hum_temp collection of the database
-    hum_temp = client.database.hum_temp
+    # Get hum_temp_days collection of the database
+    hum_temp = getCollection('hum_temp_days')
 
-    # Extract the data from the database
-    data_from_db = hum_temp.find_one({'index':'Humidity-Temperature'})
-    client.close()
+    rows_cached = 0
+    for city in cities:
+        # Number of rows of the dataset
+        size = list(hum_temp.aggregate([{'$match': {'city': city}},
+                                        {'$group': {'_id': None,
+                                                    'rows': {'$sum': {'$size': '$hour'}}}}]))
+        size = size[0]['rows'] if size else 0
+
+        # Create the column files
+        Path(cache, city).mkdir(parents=True, exist_ok=True)
+        columns = {column: np.lib.format.open_memmap(str(Path(cache, city, column+'.npy')), mode='w+',
+                                                     dtype=dtype, shape=(size,))
+                   for column, dtype in CACHE_COLUMNS.items()}
+
+        # Copy the data day by day
+        offset = 0
+        for bucket in hum_temp.find({'city': city}, BUCKET_FIELDS,
+                                    batch_size=batch_size).sort('day', 1):
+            rows = slice(offset, offset+len(bucket['hour']))
+            columns['DATE'][rows] = (np.datetime64(bucket['day'], 'h')
+                                     + np.array(bucket['hour'], dtype='timedelta64[h]'))
+            columns['TEMP'][rows] = bucket['temp']
+            columns['HUM'][rows]  = bucket['hum']
+            offset = rows.stop
+
+        for column in columns.values():
+            column.flush()
+        rows_cached += size
+
+    return rows_cached
+
+
+def readCache(cache, start=None, end=None, city=DEFAULT_CITY):
+    """
+        Reads the rows of a city between 'start' and 'end' (both
+      included) from the local columnar cache, memory-mapping the
+      column files.
+    """
+    columns = {column: np.load(str(Path(cache, city, column+'.npy')), mmap_mode='r')
+               for column in CACHE_COLUMNS}
+
+    # Dates are sorted, so the window is found with a binary search
+    dates = columns['DATE']
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 's'), 'left')
+    last  = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 's'), 'right')
+
+    return pd.DataFrame({column: np.array(values[first:last])
+                         for column, values in columns.items()})
+
+
+#######################################################################
+#                                                                     #
+# HIGH-WATER MARKS                                                    #
+#   Date of the last row processed by each step (ingestion, training  #
+#   of the models of each city), so incremental runs only process     #
+#   newer rows.                                                       #
+#                                                                     #
+#######################################################################
+def getHighWaterMark(step, city=None):
+    """
+        Returns the date of the last row processed by a step, or None.
+    """
+    # Get high_water_marks collection of the database
+    mark = getCollection('high_water_marks').find_one({'step': step, 'city': city},
+                                                      {'_id': False, 'date': True})
+
+    return None if mark is None else pd.Timestamp(mark['date'])
+
+
+def setHighWaterMark(step, date, city=None):
+    """
+        Stores the date of the last row processed by a step.
+    """
+    # Get high_water_marks collection of the database
+    getCollection('high_water_marks').update_one({'step': step, 'city': city},
+                                                 {'$set': {'date': pd.Timestamp(date).to_pydatetime()}},
+                                                 upsert=True)
+
+
+def lastDate(end=None, cache=None, city=DEFAULT_CITY):
+    """
+        Returns the date of the last row of a city (until 'end' if
+      given), or None if there are no rows.
+    """
+    end = None if end is None else pd.Timestamp(end)
+
+    if cache is not None:
+        # Only the tail of the date column is read
+        dates = np.load(str(Path(cache, city, 'DATE.npy')), mmap_mode='r')
+        last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, 's'), 'right')
+        return pd.Timestamp(dates[last-1]) if last else None
+
+    query = {'city': city}
+    if end is not None:
+        query['day'] = {'$lte': end.to_pydatetime()}
+
+    # Get the last day of the hum_temp_days collection
+    bucket = getCollection('hum_temp_days').find_one(query, {'_id': False, 'day': True, 'hour': True},
+                                                     sort=[('day', -1)])
+
+    if bucket is None:
+        return None
+    day = pd.Timestamp(bucket['day'])
+    hours = [hour for hour in bucket['hour']
+             if end is None or day + pd.Timedelta(hours=hour) <= end]
+    return day + pd.Timedelta(hours=max(hours)) if hours else lastDate(day - pd.Timedelta(seconds=1), cache, city)
+
+
+def hourlyData(data, start=None):
+    """
+        Returns a dataset with a row for every hour from 'start' (or
+      its first row) to its last row, interpolating the missing hours,
+      so the ARIMA models take a step per hour.
+    """
+    data = data.set_index('DATE')
+    first_date = data.index.min() if start is None else pd.Timestamp(start)
+    hours = pd.date_range(first_date, data.index.max(), freq='60min', name='DATE')
+    return data.reindex(hours).interpolate(method='time', limit_direction='both').reset_index()
+
+
+def trainingData(start=None, end=None, cache=None, city=DEFAULT_CITY, window=None):
+    """
+        Extracts the training subset of a city and the date of its
+      last row: a random sample of the rows between 'start' and 'end',
+      or, if 'window' is given, the rows of its last 'window' hours
+      in time order (every hour, see hourlyData).
+    """
+    if window:
+        last_date = lastDate(end, cache, city)
+        if last_date is None:
+            return loadDataSet(start, end, cache, city), None
+
+        # Only the last days are read
+        first_date = last_date - pd.Timedelta(hours=window-1)
+        if start is not None:
+            first_date = max(first_date, pd.Timestamp(start))
+        data = loadDataSet(first_date, last_date, cache, city)
+        return hourlyData(data, max(first_date, data['DATE'].min())), last_date
+
+    # Extract the data from the database (or the local cache)
+    data = loadDataSet(start, end, cache, city)
 
     # Train with a subset
-    data = pd.DataFrame(data_from_db['data'])
-    data = data.sample(n=1000)
-
-    # Humidity
-    model_hum = pm.auto_arima(data['HUM'], start_p=1, start_q=1,
-                              test='adf',       # use adftest to find optimal 'd'
-                              max_p=3, max_q=3, # maximum p and q
-                              m=1,              # frequency of series
-                              d=None,           # let model determine 'd'
-                              seasonal=False,   # No Seasonality
-                              start_P=0,
-                              D=0,
-                              trace=True,
-                              error_action='ignore',
-                              suppress_warnings=True,
-                              stepwise=True)
-    # Temperature
-    model_temp = pm.auto_arima(data['TEMP'], start_p=1, start_q=1,
-                               test='adf',       # use adftest to find optimal 'd'
-                               max_p=3, max_q=3, # maximum p and q
-                               m=1,              # frequency of series
-                               d=None,           # let model determine 'd'
-                               seasonal=False,   # No Seasonality
-                               start_P=0,
-                               D=0,
-                               trace=True,
-                               error_action='ignore',
-                               suppress_warnings=True,
-                               stepwise=True)
-
-    # Store models
-    Path(path).mkdir(parents=True, exist_ok=True)
-    pickle.dump(model_hum,  open(path+'/arima_humidity.p', 'wb'))
-    pickle.dump(model_temp, open(path+'/arima_temperature.p', 'wb'))
+    return data.sample(n=min(1000, len(data))), data['DATE'].max()
+
+
+def dateFeatures(dates):
+    """
+        Returns the input samples of the Random Forest models:
+      array of (year, month, day, hour).
+    """
+    dates = pd.to_datetime(dates)
+    return np.column_stack((dates.dt.year, dates.dt.month, dates.dt.day, dates.dt.hour))
+
+
+#######################################################################
+#                                                                     #
+# STORE MODELS                                                        #
+#   1) Write each model to a temporary joblib file and rename it, so  #
+#   the APIs never read a half-written model.                         #
+#   2) Write the manifest of the city folder, which tells the APIs    #
+#   that a new version of the models is available.                    #
+#                                                                     #
+#######################################################################
+MANIFEST = 'manifest.json'
+
+def exportARIMA(model):
+    """
+        Exports a fitted ARIMA model as the arrays of its state space
+      form and the state predicted after its last observation.
+    """
+    results = model.arima_res_.filter_results
+    state_intercept = results.state_intercept
+    if not np.allclose(state_intercept, state_intercept[:, -1:]):
+        raise ValueError("Time-varying trends cannot be exported")
+
+    origin = getattr(model, 'origin_', None)
+    return {'kind'            : np.array('arima'),
+            'design'          : results.design[0, :, -1],
+            'obs_intercept'   : results.obs_intercept[0, -1],
+            'transition'      : results.transition[:, :, -1],
+            'state_intercept' : state_intercept[:, -1],
+            'state'           : results.predicted_state[:, -1],
+            'origin'          : np.datetime64('NaT' if origin is None else origin, 's')}
+
+
+def exportForest(model):
+    """
+        Exports a fitted Random Forest as flat arrays with the nodes of
+      every tree.
+    """
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+    def children(tree, offset, children):
+        return np.where(children == -1, -1, children + offset)
+
+    return {'kind'           : np.array('forest'),
+            'children_left'  : np.concatenate([children(tree, offset, tree.children_left)
+                                               for tree, offset in zip(trees, offsets)]),
+            'children_right' : np.concatenate([children(tree, offset, tree.children_right)
+                                               for tree, offset in zip(trees, offsets)]),
+            'feature'        : np.concatenate([np.maximum(tree.feature, 0) for tree in trees]),
+            'threshold'      : np.concatenate([tree.threshold for tree in trees]),
+            'value'          : np.concatenate([tree.value[:, :, 0] for tree in trees]),
+            'roots'          : offsets[:-1]}
+
+
+def exportModel(model):
+    """
+        Exports a model for the NumPy-only predictors of the APIs
+      (predictor.py), or returns None if it is not supported.
+    """
+    if isinstance(model, pm.ARIMA):
+        return exportARIMA(model)
+    if isinstance(model, RandomForestRegressor):
+        return exportForest(model)
+    return None
+
+
+def storeModels(city_path, models, compress=0):
+    """
+        Stores the models of a city ({name: model}) in joblib files
+      ('<name>.joblib') and updates the manifest of the city folder.
+        Uncompressed files ('compress'=0) are memory-mapped by the APIs,
+      so the workers share their arrays through the page cache;
+      compressed files (1-9) are smaller to transport.
+        The supported models are also exported to NumPy files
+      (folder '<name>/', see exportModel and storeArrays), which the APIs
+      load instead.
+    """
+    Path(city_path).mkdir(parents=True, exist_ok=True)
+
+    for name, model in models.items():
+        filename = city_path+'/'+name+'.joblib'
+        joblib.dump(model, filename+'.tmp', compress=compress)
+        os.replace(filename+'.tmp', filename)
+
+        arrays = exportModel(model)
+        if arrays is not None:
+            storeArrays(city_path+'/'+name, arrays)
+
+    with open(city_path+'/'+MANIFEST+'.tmp', 'w') as manifest:
+        json.dump({'version' : datetime.now().isoformat(),
+                   'files'   : sorted(models)}, manifest)
+    os.replace(city_path+'/'+MANIFEST+'.tmp', city_path+'/'+MANIFEST)
+
+
+def storeArrays(folder, arrays):
+    """
+        Stores arrays ({name: array}) in a folder, one uncompressed
+      '.npy' file per array, so they can be memory-mapped. The folder
+      is replaced once every file has been written.
+    """
+    rmtree(folder+'.tmp', ignore_errors=True)
+    os.mkdir(folder+'.tmp')
+    for name, array in arrays.items():
+        np.save(folder+'.tmp/'+name+'.npy', array)
+
+    # Memory-mapped files of the old folder stay readable after removing it
+    rmtree(folder+'.old', ignore_errors=True)
+    if os.path.isdir(folder):
+        os.replace(folder, folder+'.old')
+    os.replace(folder+'.tmp', folder)
+    rmtree(folder+'.old', ignore_errors=True)
+
+
+def removeModels(city_path, names):
+    """
+        Removes the stored models of a city with the given names.
+    """
+    for name in names:
+        rmtree(city_path+'/'+name, ignore_errors=True)
+        # '.npz' - exports of the previous training tasks
+        for extension in ['.joblib', '.npz']:
+            if os.path.exists(city_path+'/'+name+extension):
+                os.remove(city_path+'/'+name+extension)
+
+
+#######################################################################
+#                                                                     #
+# CREATE ARIMA MODEL                                                  #
+#   1) Extract dataset from MongoDB (or the local cache).             #
+#   2) Train with the humidity and temperature sets of each city.     #
+#   3) Stores the ARIMA models with joblib ('path/<city>/').          #
+#                                                                     #
+#######################################################################
+def fitARIMA(series, stepwise=True, n_jobs=1, trace=True):
+    """
+        Fits an ARIMA model to a series.
+      'n_jobs' candidate models are fitted in parallel, which is only
+      possible without the stepwise search.
+    """
+    return pm.auto_arima(series, start_p=1, start_q=1,
+                         test='adf',       # use adftest to find optimal 'd'
+                         max_p=3, max_q=3, # maximum p and q
+                         m=1,              # frequency of series
+                         d=None,           # let model determine 'd'
+                         seasonal=False,   # No Seasonality
+                         start_P=0,
+                         D=0,
+                         trace=trace,
+                         error_action='ignore',
+                         suppress_warnings=True,
+                         stepwise=stepwise,
+                         n_jobs=1 if stepwise else n_jobs)
+
+
+def storeARIMA(path, city, model_hum, model_temp, compress=0, origin=None):
+    """
+        Stores the ARIMA models of a city with the date of their last
+      observation ('origin_'), from which their forecasts start, if
+      they were trained in time order.
+    """
+    model_hum.origin_ = model_temp.origin_ = None if origin is None else pd.Timestamp(origin)
+    storeModels(path+'/'+city, {'arima_humidity'    : model_hum,
+                                'arima_temperature' : model_temp}, compress)
+
+
+def newData(step, end=None, cache=None, city=DEFAULT_CITY):
+    """
+        Extracts the rows of a city newer than the high-water mark of
+      a training step, or None if the step has not been run yet.
+    """
+    last_date = getHighWaterMark(step, city)
+    if last_date is None:
+        return None
+
+    data = loadDataSet(last_date, end, cache, city)
+    return data[data['DATE'] > last_date]
+
+
+@timed('train_arima')
+def trainARIMA(path, start=None, end=None, cache=None, n_jobs=1, stepwise=True, trace=True,
+               cities=None, compress=0, incremental=False, window=None):
+    """
+        Creates ARIMA models (Humidity - Temperature) of each city
+      ('cities', or every stored city by default) with the data
+      between 'start' and 'end'.
+        If 'window' is given, they are trained with the last 'window'
+      hours in time order, so their forecasts start after the last
+      training row (stored as origin of the models). Otherwise, a
+      random sample is used.
+        If 'n_jobs' > 1, each model is trained in its own process and,
+      without the stepwise search, the remaining workers are used to
+      fit the candidate models of each search in parallel.
+        'compress' is the compression level of the stored models
+      (see storeModels).
+        If 'incremental' is set, the stored models are updated with the
+      rows newer than the last training instead (see updateARIMA).
+        Returns the number of training rows.
+    """
+    if cities is None:
+        cities = listCities(cache)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+
+    rows = 0
+    if incremental:
+        updated = {city: updateARIMA(path, city, end, cache, compress) for city in cities}
+        cities = [city for city, new_rows in updated.items() if new_rows is None]
+        rows = sum(new_rows for new_rows in updated.values() if new_rows is not None)
+
+    if n_jobs > 1:
+        # Humidity - Temperature of every city
+        n_models = 2*len(cities)
+        with ProcessPoolExecutor(max_workers=max(1, min(n_jobs, n_models))) as pool:
+            futures = {}
+            for city in cities:
+                data, last_date = trainingData(start, end, cache, city, window)
+                rows += len(data)
+                futures[city] = [pool.submit(fitARIMA, data[target].values, stepwise,
+                                             max(1, n_jobs//n_models), trace)
+                                 for target in ['HUM', 'TEMP']] + [last_date]
+
+            for city, (model_hum, model_temp, last_date) in futures.items():
+                storeARIMA(path, city, model_hum.result(), model_temp.result(), compress,
+                           last_date if window else None)
+                setHighWaterMark('arima', last_date, city)
+    else:
+        for city in cities:
+            data, last_date = trainingData(start, end, cache, city, window)
+            rows += len(data)
+
+            # Humidity
+            model_hum  = fitARIMA(data['HUM'].values, stepwise, trace=trace)
+            # Temperature
+            model_temp = fitARIMA(data['TEMP'].values, stepwise, trace=trace)
+
+            storeARIMA(path, city, model_hum, model_temp, compress,
+                       last_date if window else None)
+            setHighWaterMark('arima', last_date, city)
+
+    return rows
+
+
+def updateARIMA(path, city, end=None, cache=None, compress=0):
+    """
+        Updates the stored ARIMA models of a city with the rows newer
+      than the last training (the order of the models is kept), so
+      their forecasts start after the last new row. The missing hours
+      since the last training are interpolated (see hourlyData).
+        Returns the number of new rows, or None if the models have to
+      be trained from scratch.
+    """
+    city_path = path+'/'+city+'/'
+    data = newData('arima', end, cache, city)
+    if data is None or not all(os.path.exists(city_path+name+'.joblib')
+                               for name in ['arima_humidity', 'arima_temperature']):
+        return None
+    if not len(data):
+        return 0
+
+    data = hourlyData(data, getHighWaterMark('arima', city) + pd.Timedelta(hours=1))
+    model_hum  = joblib.load(city_path+'arima_humidity.joblib')
+    model_temp = joblib.load(city_path+'arima_temperature.joblib')
+    model_hum.update(data['HUM'].values)
+    model_temp.update(data['TEMP'].values)
+
+    storeARIMA(path, city, model_hum, model_temp, compress, data['DATE'].max())
+    setHighWaterMark('arima', data['DATE'].max(), city)
+    return len(data)
 
 
 #######################################################################
 #                                                                     #
 # CREATE RANDOM FOREST MODEL                                          #
-#   1) Extract dataset from MongoDB.                                  #
-#   2) Train with the humidity and temperature sets.                  #
-#   3) Stores the Random Forest models with pickle.                   #
+#   1) Extract dataset from MongoDB (or the local cache).             #
+#   2) Train with the humidity and temperature sets of each city.     #
+#   3) Stores the Random Forest models with joblib ('path/<city>/').  #
 #                                                                     #
 #######################################################################
-def trainRandomForest(path):
+@timed('train_rf')
+def trainRandomForest(path, multioutput=False, start=None, end=None, cache=None, cities=None,
+                      compress=0, incremental=False):
     """
-        Creates Random Forest models (Humidity - Temperature).
+        Creates Random Forest models (Humidity - Temperature) of each
+      city ('cities', or every stored city by default) with the data
+      between 'start' and 'end'.
+        If 'multioutput' is set, a single model predicting both
+      temperature and humidity is created instead.
+        'compress' is the compression level of the stored models
+      (see storeModels).
+        If 'incremental' is set, new trees are added to the stored
+      models with the rows newer than the last training instead
+      (see updateRandomForest).
+        Returns the number of training rows.
     """
-    # Connect to MongoDB
-    client = MongoClient('localhost', 27017)
+    if cities is None:
+        cities = listCities(cache)
 
-    # Get hum_temp collection of the database
-    hum_temp = client.database.hum_temp
+    rows = 0
+    for city in cities:
+        new_rows = updateRandomForest(path, city, multioutput, end, cache, compress) if incremental else None
+        if new_rows is not None:
+            rows += new_rows
+            continue
 
-    # Extract the data from the database
-    data_from_db = hum_temp.find_one({'index':'Humidity-Temperature'})
-    client.close()
+        data, last_date = trainingData(start, end, cache, city)
+        rows += len(data)
 
-    # Train with a subset
-    data = pd.DataFrame(data_from_db['data'])
-    data = data.sample(n=1000)
-
-    # Training input samples: list of (year, month, day, hour)
-    #  -> (NOTE) DATE column format: "%Y-%m-%d %H:%M:%S"
-    X = [(datetime[:4], datetime[5:7], datetime[8:10], datetime[11:13])
-         for datetime in data['DATE']]
-
-    # Humidity
-    model_hum = RandomForestRegressor(max_depth=50,
-                                      n_jobs=-1).fit(X, data['HUM'])
-    # Temperature
-    model_temp = RandomForestRegressor(max_depth=50,
-                                      n_jobs=-1).fit(X, data['TEMP'])
-
-    # Store models
-    Path(path).mkdir(parents=True, exist_ok=True)
-    pickle.dump(model_hum,  open(path+'/rf_humidity.p', 'wb'))
-    pickle.dump(model_temp, open(path+'/rf_temperature.p', 'wb'))
+        # Training input samples: array of (year, month, day, hour)
+        X = dateFeatures(data['DATE'])
+
+        # The APIs use the multi-output model whenever it exists, so the
+        # models of the other layout are removed before storing the new ones
+        if multioutput:
+            # Temperature - Humidity
+            model_temp_hum = RandomForestRegressor(max_depth=50,
+                                                   n_jobs=-1).fit(X, data[['TEMP', 'HUM']])
+
+            # Store model
+            removeModels(path+'/'+city, ['rf_humidity', 'rf_temperature'])
+            storeModels(path+'/'+city, {'rf_temp_hum': model_temp_hum}, compress)
+        else:
+            # Humidity
+            model_hum = RandomForestRegressor(max_depth=50,
+                                              n_jobs=-1).fit(X, data['HUM'])
+            # Temperature
+            model_temp = RandomForestRegressor(max_depth=50,
+                                              n_jobs=-1).fit(X, data['TEMP'])
+
+            # Store models
+            removeModels(path+'/'+city, ['rf_temp_hum'])
+            storeModels(path+'/'+city, {'rf_humidity'    : model_hum,
+                                        'rf_temperature' : model_temp}, compress)
+
+        setHighWaterMark('rf', last_date, city)
+
+    return rows
+
+
+def updateRandomForest(path, city, multioutput=False, end=None, cache=None, compress=0,
+                       n_estimators=10, max_estimators=150, min_rows=24):
+    """
+        Adds 'n_estimators' trees, trained with the rows newer than the
+      last training, to the stored Random Forest models of a city.
+      The new rows wait for the next run until there are 'min_rows'.
+        Returns the number of new rows, or None if the models have to
+      be trained from scratch (no models, or more than 'max_estimators'
+      trees after the update, so the forests do not grow without limit).
+    """
+    city_path = path+'/'+city+'/'
+    targets = ({'rf_temp_hum': ['TEMP', 'HUM']} if multioutput else
+               {'rf_humidity': 'HUM', 'rf_temperature': 'TEMP'})
+
+    data = newData('rf', end, cache, city)
+    if data is None or not all(os.path.exists(city_path+name+'.joblib') for name in targets):
+        return None
+    if len(data) < min_rows:
+        return 0
+
+    models = {name: joblib.load(city_path+name+'.joblib') for name in targets}
+    if any(len(model.estimators_) + n_estimators > max_estimators for model in models.values()):
+        return None
+
+    X = dateFeatures(data['DATE'])
+    for name, target in targets.items():
+        model = models[name]
+        model.set_params(warm_start=True, n_estimators=len(model.estimators_)+n_estimators)
+        model.fit(X, data[target])
+
+    storeModels(path+'/'+city, models, compress)
+    setHighWaterMark('rf', data['DATE'].max(), city)
+    return len(data)
@@ -0,0 +1,134 @@
+"""
+    Asynchronous serving mode (ASGI) of the microservices.
+
+    The routes are the ones of the Flask app of API$VERSION. The forecasts
+    are computed in a bounded thread pool (INFERENCE_WORKERS threads) and
+    concurrent requests for the same city and hour share one computation,
+    so a slow prediction does not block the event loop nor the rest of the
+    requests. Run it with an async worker class, e.g.:
+
+        ASYNC=1 gunicorn -c gunicorn.conf.py
+
+    @author: Mar Alguacil
+"""
+import io
+import os
+import re
+import sys
+import asyncio
+import importlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+api = importlib.import_module('API' + os.environ.get('VERSION', 'v1'))
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('INFERENCE_WORKERS', 4)))
+
+# Routes served from the forecast cache: /servicio/vX[/<city>]/prediccion[/<N>horas]
+FORECAST_ROUTE = re.compile(r'^/servicio/v\d+/(?:(?P<city>[^/]+)/)?prediccion(?:/\d+horas)?$')
+
+# Forecasts being computed: (city, hour) -> future
+pending = {}
+
+
+async def prepareForecast(city):
+    """
+        Computes the forecast of a city in the thread pool, sharing the
+      computation with the concurrent requests for the same city and hour.
+    """
+    loop = asyncio.get_running_loop()
+    key = (city, datetime.now().strftime('%Y-%m-%d %H'))
+
+    future = pending.get(key)
+    if future is None:
+        # The lookup of the request is recorded by the Flask route
+        future = loop.run_in_executor(executor, api.forecasts.get, city, False)
+        pending[key] = future
+        future.add_done_callback(lambda _: pending.pop(key, None))
+
+    try:
+        await future
+    except Exception:
+        pass # The Flask route returns the error (e.g. unknown city)
+
+
+def callWSGI(scope, body):
+    """
+        Runs the Flask app for an ASGI HTTP request.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD'    : scope['method'],
+               'SCRIPT_NAME'       : scope.get('root_path', '').encode('utf8').decode('latin1'),
+               'PATH_INFO'         : scope['path'].encode('utf8').decode('latin1'),
+               'QUERY_STRING'      : scope['query_string'].decode('latin1'),
+               'SERVER_NAME'       : server[0],
+               'SERVER_PORT'       : str(server[1]),
+               'SERVER_PROTOCOL'   : 'HTTP/' + scope.get('http_version', '1.1'),
+               'REMOTE_ADDR'       : scope['client'][0] if scope.get('client') else '',
+               'CONTENT_LENGTH'    : str(len(body)),
+               'wsgi.version'      : (1, 0),
+               'wsgi.url_scheme'   : scope.get('scheme', 'http'),
+               'wsgi.input'        : io.BytesIO(body),
+               'wsgi.errors'       : sys.stderr,
+               'wsgi.multithread'  : True,
+               'wsgi.multiprocess' : True,
+               'wsgi.run_once'     : False}
+
+    for name, value in scope['headers']:
+        name  = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif name != 'CONTENT_LENGTH':
+            name = 'HTTP_' + name
+            environ[name] = environ[name] + ',' + value if name in environ else value
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status']  = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                               for name, value in headers]
+
+    result = api.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response['status'], response['headers'], body
+
+
+async def app(scope, receive, send):
+    """
+        ASGI application.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    route = FORECAST_ROUTE.match(scope['path'])
+    if route and scope['method'] in ('GET', 'HEAD'):
+        await prepareForecast(route.group('city') or api.DEFAULT_CITY)
+
+    # The Flask app may still load the models or predict (failed computation,
+    # new hour or version of the models), so it never runs in the event loop
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(
+                                executor, callWSGI, scope, body)
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,243 @@
+"""
+    Benchmarks of the ingestion, training and serving hot paths.
+
+    Every stage runs on synthetic hourly datasets (humidity.csv and
+    temperature.csv in the format of the downloaded files) ending at the
+    current hour, with an in-process MongoDB (mongomock) and small models
+    stored in a temporary folder. For each stage, the latency percentiles,
+    the throughput (rows or requests per second) and the peak memory
+    allocated are reported as JSON, so the results of two commits can be
+    compared:
+
+        python benchmark.py --rows 2000 --cities 4 --output new.json
+        python benchmark.py --compare old.json new.json
+
+    @author: Mar Alguacil
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+
+# The APIs must not look for new models in the background
+os.environ['MODELS_RELOAD_INTERVAL'] = '0'
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AirFlow'))
+import mongomock
+import mongo
+import utils
+
+STAGES = ['ingest', 'ingest_chunks', 'cache', 'train_arima', 'train_rf', 'forecast_v1', 'forecast_v2']
+
+
+def syntheticData(path, rows, cities, seed=0):
+    """
+        Writes 'rows' hours of humidity and temperature of 'cities'
+      cities, ending at the current hour, with daily cycles, noise and
+      some missing values. Returns the keys of the cities.
+    """
+    random = np.random.default_rng(seed)
+    dates = pd.date_range(end=pd.Timestamp.now().floor('h'), periods=rows, freq='60min')
+    cycle = np.sin(2*np.pi*dates.hour/24)
+    names = ['City ' + str(city) for city in range(cities)]
+
+    for filename, mean, amplitude in [('humidity.csv', 70, 10), ('temperature.csv', 285, 5)]:
+        data = pd.DataFrame({name: mean + amplitude*cycle + random.normal(0, 1, rows)
+                             for name in names})
+        data[data.apply(lambda column: random.random(rows) < 0.01)] = np.nan
+        data.insert(0, 'datetime', dates.strftime('%Y-%m-%d %H:%M:%S'))
+        data.to_csv(os.path.join(path, filename), index=False)
+
+    return [utils.cityKey(name) for name in names]
+
+
+def measure(function, repeat=1, items=1, setup=None):
+    """
+        Runs 'function' 'repeat' times ('setup' before each run, not
+      measured) and returns its latency percentiles (ms), throughput
+      ('items' per second) and peak memory allocated (MiB). The memory
+      is traced with tracemalloc, which slows every run down alike.
+    """
+    latencies, peak = [], 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    return {'runs'       : repeat,
+            'p50_ms'     : round(float(np.percentile(latencies, 50))*1000, 3),
+            'p90_ms'     : round(float(np.percentile(latencies, 90))*1000, 3),
+            'p99_ms'     : round(float(np.percentile(latencies, 99))*1000, 3),
+            'throughput' : round(items*repeat/float(latencies.sum()), 3),
+            'peak_mib'   : round(peak/2**20, 3)}
+
+
+def serve(version, path, requests):
+    """
+        Returns a function that sends 'requests' forecast requests to
+      an API through the Flask test client, and the function that
+      empties its forecast cache.
+    """
+    api = __import__('API' + version)
+    api.models.path = path
+    api.models.models.clear()
+    client = api.app.test_client()
+    city = api.models.cities()[0]
+    urls = ['/servicio/' + version + '/' + city + '/prediccion/' + interval + 'horas'
+            for interval in ['24', '48', '72']]
+
+    def run():
+        for request in range(requests):
+            assert client.get(urls[request % len(urls)]).status_code == 200
+
+    return run, api.forecasts.forecasts.clear
+
+
+def benchmark(rows=2000, cities=4, repeat=5, requests=100, window=240, stages=STAGES):
+    """
+        Runs the benchmarks of the given stages and returns the results.
+    """
+    path = tempfile.mkdtemp()
+    models = os.path.join(path, 'models') + '/'
+    cache = os.path.join(path, 'cache')
+    hum_file, temp_file = os.path.join(path, 'humidity.csv'), os.path.join(path, 'temperature.csv')
+    client = mongomock.MongoClient()
+    mongo.MongoClient = lambda *args, **kwargs: client
+    mongo.resetClient()
+
+    def emptyDatabase():
+        client.drop_database(mongo.MONGO_DATABASE)
+
+    results = {}
+    try:
+        syntheticData(path, rows, cities)
+        size = rows*cities
+
+        # Ingestion (the dataset is left in the database for the next stages)
+        if 'ingest' in stages:
+            results['ingest'] = measure(lambda: utils.mergeDataSets(hum_file, temp_file),
+                                        repeat, size, emptyDatabase)
+        if 'ingest_chunks' in stages:
+            results['ingest_chunks'] = measure(lambda: utils.mergeDataSets(hum_file, temp_file, chunksize=1000),
+                                               repeat, size, emptyDatabase)
+        if not client.database.hum_temp_days.count_documents({}):
+            utils.mergeDataSets(hum_file, temp_file)
+
+        if 'cache' in stages:
+            results['cache'] = measure(lambda: utils.cacheDataSet(cache), repeat, size)
+        else:
+            utils.cacheDataSet(cache)
+
+        # Training (small models: last 'window' hours for ARIMA, 1000 rows for Random Forest)
+        train_arima = lambda: utils.trainARIMA(models, cache=cache, trace=False, window=window)
+        train_rf    = lambda: utils.trainRandomForest(models, multioutput=True, cache=cache)
+        if 'train_arima' in stages:
+            results['train_arima'] = measure(train_arima, 1, min(window, rows)*cities)
+        elif 'forecast_v1' in stages:
+            train_arima()
+        if 'train_rf' in stages:
+            results['train_rf'] = measure(train_rf, 1, min(1000, rows)*cities)
+        elif 'forecast_v2' in stages:
+            train_rf()
+
+        # Serving: the first request of each hour computes the forecast
+        for version in ['v1', 'v2']:
+            if 'forecast_' + version in stages:
+                request, clear = serve(version, models, 1)
+                results['forecast_' + version + '_cold'] = measure(request, repeat, 1, clear)
+                run, _ = serve(version, models, requests)
+                results['forecast_' + version] = measure(run, repeat, requests)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    return results
+
+
+def commit():
+    """
+        Returns the current git commit, or None outside a repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old, new, threshold=1.2):
+    """
+        Prints the p50 latency of each stage of two results files and
+      returns the stages that are more than 'threshold' times slower.
+    """
+    with open(old) as old_file, open(new) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    if old['parameters'] != new['parameters']:
+        print('Warning: the benchmarks were run with different parameters')
+
+    regressions = []
+    print('%-22s %12s %12s %8s' % ('stage', old['commit'], new['commit'], 'ratio'))
+    for stage in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][stage]['p50_ms'], new['results'][stage]['p50_ms']
+        ratio = after/before if before else float('inf')
+        print('%-22s %12.3f %12.3f %8.2f' % (stage, before, after, ratio))
+        if ratio > threshold:
+            regressions.append(stage)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000, help='hours of the synthetic datasets')
+    parser.add_argument('--cities', type=int, default=4, help='cities of the synthetic datasets')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each stage')
+    parser.add_argument('--requests', type=int, default=100, help='requests of each serving run')
+    parser.add_argument('--window', type=int, default=240, help='training hours of the ARIMA models')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--output', help='results file (standard output by default)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files (exit status 1 on regressions)')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='p50 latency ratio considered a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1 if regressions else 0)
+
+    # The steps print their metrics, which must not be mixed with the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = benchmark(args.rows, args.cities, args.repeat, args.requests,
+                            args.window, args.stages)
+
+    report = {'commit'     : commit(),
+              'date'       : pd.Timestamp.now().isoformat(),
+              'python'     : platform.python_version(),
+              'parameters' : {'rows': args.rows, 'cities': args.cities, 'repeat': args.repeat,
+                              'requests': args.requests, 'window': args.window},
+              'results'    : results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,240 @@
+"""
+    Forecast cache and response encoding shared by the microservices.
+
+    @author: Mar Alguacil
+"""
+import json
+import numpy as np
+import pandas as pd
+from threading import Lock
+from flask import Response, request
+from metrics import forecast_seconds, cache_requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Maximum number of queries of a batch request
+MAX_BATCH = 100
+
+# Response formats (chosen by the Accept header):
+#  - records - [{'hour': ..., 'temp': ..., 'hum': ...}, ...]
+#  - columns - {'hour': [...], 'temp': [...], 'hum': [...]}
+#  - msgpack - columns packed with MessagePack
+MIMETYPES = {'application/json'             : 'records',
+             'application/vnd.columns+json' : 'columns'}
+if msgpack is not None:
+    MIMETYPES['application/msgpack'] = 'msgpack'
+
+
+class ForecastError(Exception):
+    """
+        The models of a city cannot forecast the next hours.
+    """
+
+
+def dumps(data):
+    """
+        Serializes data (which may contain NumPy arrays) to JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda array: array.tolist()).encode()
+
+
+class ForecastCache:
+    """
+        Keeps the forecast of each city for the next 'horizon' hours.
+      The forecast only depends on the models and the current hour, so
+      it is computed once per clock hour (and model version) and every
+      request is served with a slice of it.
+    """
+    def __init__(self, models, predict, horizon=72):
+        self.models = models    # ModelRegistry
+        self.predict = predict  # predict(city_models, dates) -> (temperature, humidity)
+        self.horizon = horizon
+        self.forecasts = {}
+        self.locks = {}
+        self.lock = Lock()
+
+    def get(self, city, record=True):
+        """
+            Returns the forecast of a city:
+              {'dates': DatetimeIndex, 'hour': [...], 'temp': array, 'hum': array}
+          Raises KeyError if there are no models for the city.
+            Each request looks the forecast up once, which is recorded in
+          the cache metrics ('record'): the first lookup of a forecast is a
+          miss, even if it was computed beforehand without recording it.
+        """
+        version, city_models = self.models.entry(city)
+        first_hour = pd.Timestamp.now().floor('h') + pd.Timedelta(hours=1)
+        key = (first_hour, version, id(city_models))
+
+        with self.lock:
+            forecast = self.forecasts.get(city)
+            city_lock = self.locks.setdefault(city, Lock())
+
+        if forecast is not None and forecast['key'] == key:
+            if record:
+                self.record(forecast)
+            return forecast
+
+        # Concurrent requests for the same city wait for a single computation,
+        # without blocking the requests for other cities
+        with city_lock:
+            forecast = self.forecasts.get(city)
+            if forecast is None or forecast['key'] != key:
+                # Next 'horizon' hours
+                with forecast_seconds.time(stage='dates'):
+                    dates = pd.date_range(first_hour, periods=self.horizon, freq='60min')
+                    hours = dates.strftime('%d/%m/%Y %H:%M').tolist()
+                with forecast_seconds.time(stage='predict'):
+                    forecast_temp, forecast_hum = self.predict(city_models, dates)
+
+                forecast = {'key'   : key,
+                            'tag'   : city + '-' + first_hour.strftime('%Y%m%d%H') + '-' + str(version),
+                            'dates' : dates,
+                            'hour'  : hours,
+                            'temp'  : np.round(np.asarray(forecast_temp, dtype=float), 2),
+                            'hum'   : np.round(np.asarray(forecast_hum, dtype=float), 2),
+                            'responses': {},
+                            'recorded' : False}
+                self.forecasts[city] = forecast
+
+        if record:
+            self.record(forecast)
+        return forecast
+
+    def record(self, forecast):
+        """
+            Records a lookup of a forecast in the cache metrics.
+        """
+        with self.lock:
+            result = 'hit' if forecast['recorded'] else 'miss'
+            forecast['recorded'] = True
+        cache_requests.inc(cache='forecast', result=result)
+
+    def encode(self, forecast, first, last, format='records'):
+        """
+            Serializes the hours 'first' to 'last' (excluded) of a forecast.
+        """
+        with forecast_seconds.time(stage='serialize'):
+            return self.serialize(forecast, first, last, format)
+
+    def serialize(self, forecast, first, last, format):
+        hours = forecast['hour'][first:last]
+        temp  = forecast['temp'][first:last]
+        hum   = forecast['hum'][first:last]
+
+        if format == 'columns':
+            return dumps({'hour': hours, 'temp': temp, 'hum': hum})
+        if format == 'msgpack':
+            return msgpack.packb({'hour': hours, 'temp': temp.tolist(), 'hum': hum.tolist()})
+        return dumps([{'hour': date, 'temp': temperature, 'hum': humidity}
+                      for date, temperature, humidity
+                          in zip(hours, temp.tolist(), hum.tolist())])
+
+    def response(self, forecast, first=0, last=None, format='records'):
+        """
+            Returns the serialized forecast between the hours 'first' and
+          'last' (excluded), and its ETag.
+        """
+        etag = forecast['tag'] + '-' + str(first) + '-' + str(last) + '-' + format
+        if first != 0:
+            return self.encode(forecast, first, last, format), etag
+
+        # The forecasts for the next hours are kept serialized
+        if (last, format) not in forecast['responses']:
+            cache_requests.inc(cache='response', result='miss')
+            forecast['responses'][last, format] = self.encode(forecast, first, last, format)
+        else:
+            cache_requests.inc(cache='response', result='hit')
+        return forecast['responses'][last, format], etag
+
+    def hours(self, forecast, hours=None, start=None, end=None):
+        """
+            Returns the hours of a forecast ('first', 'last') for the next
+          'hours' hours or between 'start' and 'end'. Raises ValueError if
+          they are not within the forecast.
+        """
+        if hours is not None:
+            if not str(hours).isdigit() or not 0 < int(hours) <= self.horizon:
+                raise ValueError("Lo siento, sólo trabajamos con predicciones para las próximas "
+                                 + str(self.horizon) + " horas.")
+            return 0, int(hours)
+
+        dates = forecast['dates']
+        try:
+            start = dates[0] if start is None else localTime(start)
+            end   = dates[-1] if end is None else localTime(end)
+        except (TypeError, ValueError):
+            raise ValueError("Lo siento, las fechas deben tener el formato AAAA-MM-DD HH:MM.")
+
+        first = dates.searchsorted(start, 'left')
+        last  = dates.searchsorted(end, 'right')
+        if first >= last:
+            raise ValueError("Lo siento, sólo trabajamos con predicciones entre "
+                             + dates[0].strftime('%d/%m/%Y %H:%M') + " y "
+                             + dates[-1].strftime('%d/%m/%Y %H:%M') + ".")
+        return first, last
+
+    def batch(self, queries, default_city):
+        """
+            Returns the serialized forecasts of a list of queries, each one
+          with the city ('ciudad') and the next hours ('horas') or the
+          dates ('desde', 'hasta'). The forecast of each city is only
+          computed once; wrong queries get {'error': message}.
+        """
+        if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+            raise ValueError("Lo siento, las consultas deben ser una lista de objetos JSON.")
+        if len(queries) > MAX_BATCH:
+            raise ValueError("Lo siento, sólo trabajamos con " + str(MAX_BATCH) + " consultas a la vez.")
+
+        responses = []
+        for query in queries:
+            city = str(query.get('ciudad', default_city))
+            try:
+                forecast = self.get(city)
+                first, last = self.hours(forecast, query.get('horas'), query.get('desde'), query.get('hasta'))
+                responses.append(self.response(forecast, first, last)[0])
+            except KeyError:
+                responses.append(dumps({'error': "Lo siento, no hay predicciones para " + city + "."}))
+            except (ValueError, ForecastError) as error:
+                responses.append(dumps({'error': str(error)}))
+
+        return b'[' + b','.join(responses) + b']'
+
+
+def localTime(date):
+    """
+        Parses a date as the local time (without time zone) of the
+      forecasts, converting it if it has a time zone ('Z', '+02:00').
+    """
+    date = pd.Timestamp(date)
+    if date.tzinfo is not None:
+        date = pd.Timestamp(date.to_pydatetime().astimezone().replace(tzinfo=None))
+    return date
+
+
+def forecastResponse(forecasts, forecast, first=0, last=None):
+    """
+        Builds the HTTP response with a forecast (see ForecastCache.get)
+      in the format chosen by the Accept header. It can be cached until
+      the next hour and repeated requests with its ETag get a 304 response.
+    """
+    mimetype = request.accept_mimetypes.best_match(list(MIMETYPES), 'application/json')
+    body, etag = forecasts.response(forecast, first, last, MIMETYPES[mimetype])
+
+    response = Response(body, status=200, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = int((forecast['dates'][0] - pd.Timestamp.now()).total_seconds())
+    response.vary.add('Accept')
+
+    return response.make_conditional(request)
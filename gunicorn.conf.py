@@ -0,0 +1,52 @@
+"""
+    Gunicorn configuration of the microservices.
+
+    The API module and the models are loaded once in the master process
+    (preload_app) and shared copy-on-write with the forked workers, so
+    adding workers does not load the models again.
+
+    Environment variables:
+      - VERSION        - API version (v1 or v2).
+      - PORT           - port to listen on.
+      - WORKERS        - number of workers (number of cores by default).
+      - PRELOAD_CITIES - comma-separated cities whose models are loaded in
+                         the master ('all' for every city, the default city
+                         if not set).
+      - ASYNC          - if set to 1, serve the ASGI app (asgi.py) with
+                         uvicorn workers, each one handling many concurrent
+                         requests.
+
+    @author: Mar Alguacil
+"""
+import os
+import gc
+import sys
+import multiprocessing
+
+wsgi_app = 'API' + os.environ.get('VERSION', 'v1') + ':app'
+if os.environ.get('ASYNC') == '1':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count()))
+preload_app = True
+
+
+def when_ready(server):
+    """
+        Loads the models in the master before forking the workers.
+    """
+    api = sys.modules['API' + os.environ.get('VERSION', 'v1')]
+
+    cities = os.environ.get('PRELOAD_CITIES', api.DEFAULT_CITY)
+    if cities == 'all':
+        cities = api.models.cities()
+    else:
+        cities = [city.strip() for city in cities.split(',') if city.strip()]
+    api.models.preload(cities)
+
+    # Move every object loaded so far to a permanent generation, so the
+    # garbage collector of the workers does not write to (and copy) the
+    # shared memory pages when traversing them
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,173 @@
+"""
+    Runtime metrics of the microservices in the Prometheus text format.
+
+    Each process keeps its own metrics, so with several gunicorn workers
+    every scrape of /metrics reports the worker that serves it (see the
+    'pid' label of process_start_time_seconds).
+
+    @author: Mar Alguacil
+"""
+import os
+import time
+from threading import Lock
+from contextlib import contextmanager
+from flask import Response, request
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+        Metric with a value for each combination of label values.
+    """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+        METRICS.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format(self, key, suffix='', extra=()):
+        """
+            Returns the name of a sample with its labels.
+        """
+        labels = list(zip(self.labels, key)) + list(extra)
+        if not labels:
+            return self.name + suffix
+        return (self.name + suffix + '{'
+                + ','.join(label + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                           for label, value in labels) + '}')
+
+    def samples(self):
+        with self.lock:
+            return [(self.format(key), value) for key, value in sorted(self.values.items())]
+
+    def exposition(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' ' + self.type]
+        lines += [name + ' ' + repr(float(value)) for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # [count of each bucket, sum, count]
+            counts = self.values.setdefault(key, [0]*len(BUCKETS) + [0, 0])
+            for bucket, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+            Observes the duration of the block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            samples = []
+            for key, counts in sorted(self.values.items()):
+                for bound, count in zip(BUCKETS, counts):
+                    samples.append((self.format(key, '_bucket', [('le', repr(float(bound)))]), count))
+                samples.append((self.format(key, '_bucket', [('le', '+Inf')]), counts[-1]))
+                samples.append((self.format(key, '_sum'), counts[-2]))
+                samples.append((self.format(key, '_count'), counts[-1]))
+            return samples
+
+
+METRICS = []
+
+process_start = Gauge('process_start_time_seconds', 'Start time of the process since the epoch.', ('pid',))
+
+requests_total = Counter('http_requests_total', 'HTTP requests.', ('route', 'method', 'status'))
+request_seconds = Histogram('http_request_duration_seconds', 'Duration of the HTTP requests.', ('route',))
+forecast_seconds = Histogram('forecast_stage_duration_seconds',
+                             'Duration of the forecast stages (dates, predict, serialize).', ('stage',))
+cache_requests = Counter('forecast_cache_requests_total',
+                         'Forecast cache lookups (hit or miss).', ('cache', 'result'))
+model_load_seconds = Histogram('model_load_duration_seconds', 'Duration of the model loads.', ('city',))
+model_version = Gauge('model_version', 'Version (manifest modification time) of the loaded models.', ('city',))
+
+
+def startProcess():
+    """
+        Records the start of the (forked) process.
+    """
+    for metric in METRICS:
+        # The locks may have been held by a thread of the parent
+        metric.lock = Lock()
+    process_start.values.clear()
+    process_start.set(time.time(), pid=os.getpid())
+
+startProcess()
+os.register_at_fork(after_in_child=startProcess)
+
+
+def exposition():
+    """
+        Returns every metric in the Prometheus text format.
+    """
+    return '\n'.join(metric.exposition() for metric in METRICS) + '\n'
+
+
+def instrument(app):
+    """
+        Counts and times the requests of a Flask app and adds the
+      /metrics route.
+    """
+    @app.before_request
+    def startTimer():
+        request.start_time = time.perf_counter()
+
+    @app.after_request
+    def recordRequest(response):
+        # Routes are reported by their rule, not by the requested URL
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        if route != '/metrics':
+            request_seconds.observe(time.perf_counter() - request.start_time, route=route)
+            requests_total.inc(route=route, method=request.method, status=response.status_code)
+        return response
+
+    @app.route("/metrics", methods=['GET'])
+    def metrics():
+        """
+            Displays the runtime metrics.
+        """
+        return Response(exposition(), status=200, mimetype='text/plain; version=0.0.4')
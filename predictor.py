@@ -0,0 +1,109 @@
+"""
+    NumPy-only predictors of the models exported by the training tasks
+    (see exportModel in AirFlow/utils.py), so the microservices do not
+    need pmdarima, statsmodels, scipy nor scikit-learn to serve them.
+
+    @author: Mar Alguacil
+"""
+import os
+import numpy as np
+
+
+class ARIMAPredictor:
+    """
+        Forecasts of an ARIMA model from its state space form:
+          y(t)   = Z·a(t) + d
+          a(t+1) = T·a(t) + c
+      where a is the state predicted after the last observation.
+    """
+    def __init__(self, design, obs_intercept, transition, state_intercept, state, origin=None):
+        self.design = design
+        self.obs_intercept = float(obs_intercept)
+        self.transition = transition
+        self.state_intercept = state_intercept
+        self.state = state
+        self.origin_ = origin
+
+    def advance(self, steps):
+        """
+            Returns the state predicted 'steps' periods ahead with a power
+          of the augmented transition [[T, c], [0, 1]], so distant states
+          take O(log steps) matrix products.
+        """
+        size = len(self.state)
+        augmented = np.zeros((size+1, size+1))
+        augmented[:size, :size] = self.transition
+        augmented[:size, size] = self.state_intercept
+        augmented[size, size] = 1
+        return (np.linalg.matrix_power(augmented, steps) @ np.append(self.state, 1))[:size]
+
+    def predict(self, n_periods=10, skip=0):
+        """
+            Forecasts the 'n_periods' observations that follow the next
+          'skip' ones.
+        """
+        forecast = np.empty(n_periods)
+        state = self.advance(skip) if skip else self.state.copy()
+        for period in range(n_periods):
+            forecast[period] = self.design @ state
+            state = self.transition @ state + self.state_intercept
+        return forecast + self.obs_intercept
+
+
+class ForestPredictor:
+    """
+        Predictions of a forest of regression trees stored as flat
+      arrays of nodes: the children of each node (-1 for the leaves),
+      the feature and threshold of its split and its value, and the
+      root node of each tree.
+    """
+    def __init__(self, children_left, children_right, feature, threshold, value, roots):
+        self.children_left = children_left
+        self.children_right = children_right
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value      # (nodes, outputs)
+        self.roots = roots
+
+    def apply(self, X):
+        """
+            Returns the leaf of each tree reached by each sample: (trees, samples).
+        """
+        # The trees compare the features as float32 values
+        X = np.asarray(X, dtype=np.float32)
+        samples = np.arange(len(X))
+        nodes = np.repeat(self.roots[:, None], len(X), axis=1)
+
+        while True:
+            left = self.children_left[nodes]
+            inner = left != -1
+            if not inner.any():
+                return nodes
+            go_left = X[samples, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(inner, np.where(go_left, left, self.children_right[nodes]), nodes)
+
+    def predict(self, X):
+        """
+            Predicts the average value of the trees: (samples,) or
+          (samples, outputs) for several outputs.
+        """
+        prediction = self.value[self.apply(X)].mean(axis=0)
+        return prediction[:, 0] if prediction.shape[1] == 1 else prediction
+
+
+def loadPredictor(folder):
+    """
+        Loads an exported model (a folder with a '.npy' file per array).
+      The arrays are memory-mapped read-only, so the workers share them
+      through the page cache.
+    """
+    arrays = {filename[:-len('.npy')]: np.load(os.path.join(folder, filename), mmap_mode='r')
+              for filename in os.listdir(folder) if filename.endswith('.npy')}
+
+    kind = str(arrays.pop('kind'))
+    if kind == 'arima':
+        origin = arrays.pop('origin')[()]
+        return ARIMAPredictor(origin=None if np.isnat(origin) else origin, **arrays)
+    if kind == 'forest':
+        return ForestPredictor(**arrays)
+    raise ValueError("Unknown model: " + kind)
@@ -0,0 +1,189 @@
+"""
+    Lazy loading and hot reloading of the forecast models of each city.
+
+    @author: Mar Alguacil
+"""
+import os
+import time
+import pickle
+import joblib
+import logging
+from threading import Lock, Thread
+from collections import OrderedDict
+from metrics import model_load_seconds, model_version
+from predictor import loadPredictor
+
+# City served by the routes without a city
+DEFAULT_CITY = 'san_francisco'
+
+# File written by the training tasks after storing the models of a city
+MANIFEST = 'manifest.json'
+
+logger = logging.getLogger(__name__)
+
+
+def loadModel(path, name):
+    """
+        Loads a model exported to NumPy (folder '<name>/'), which only
+      needs the predictors of predictor.py. Models of older training tasks are
+      loaded from joblib ('<name>.joblib'), memory-mapping their arrays
+      copy-on-write (some models write to their buffers), or pickle
+      ('<name>.p') files, which need pmdarima or scikit-learn.
+    """
+    if os.path.isdir(path+name):
+        return loadPredictor(path+name)
+
+    if os.path.exists(path+name+'.joblib'):
+        return joblib.load(path+name+'.joblib', mmap_mode='c')
+
+    with open(path+name+'.p', 'rb') as model_file:
+        return pickle.load(model_file)
+
+
+class ModelRegistry:
+    """
+        Loads the models of a city ('path/<city>/') the first time
+      they are requested and keeps at most 'maxsize' cities in memory,
+      unloading the least recently used ones.
+        New versions of the loaded models are loaded in the background
+      (see watch) and swapped in, so requests keep being served with
+      the previous version meanwhile.
+    """
+    def __init__(self, path, load, maxsize=8):
+        self.path = path
+        self.load = load        # load(city_path) -> models
+        self.maxsize = maxsize
+        self.models = OrderedDict() # city -> (version, models)
+        self.loading = {}           # city -> lock held while loading its models
+        self.lock = Lock()
+
+    def cities(self):
+        """
+            Lists the cities with trained models.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(city for city in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, city)))
+
+    def version(self, city):
+        """
+            Returns the version of the models of a city: the modification
+          time of its manifest or, without manifest, of its newest file.
+        """
+        city_path = os.path.join(self.path, city)
+        manifest = os.path.join(city_path, MANIFEST)
+        if os.path.exists(manifest):
+            return os.stat(manifest).st_mtime_ns
+        return max((entry.stat().st_mtime_ns for entry in os.scandir(city_path)
+                    if entry.is_file()), default=0)
+
+    def get(self, city):
+        """
+            Returns the models of a city, loading them if needed.
+          Raises KeyError if there are no models for the city.
+        """
+        return self.entry(city)[1]
+
+    def entry(self, city):
+        """
+            Returns the version and the models of a city, loading them
+          if needed. Raises KeyError if there are no models for the city.
+        """
+        with self.lock:
+            if city in self.models:
+                self.models.move_to_end(city)
+                return self.models[city]
+
+        city_path = os.path.join(self.path, city)
+        if city.startswith('.') or not os.path.isdir(city_path):
+            raise KeyError(city)
+
+        with self.lock:
+            city_lock = self.loading.setdefault(city, Lock())
+
+        # Concurrent requests for the same city wait for a single load,
+        # without blocking the requests for other cities
+        with city_lock:
+            with self.lock:
+                if city in self.models:
+                    self.models.move_to_end(city)
+                    return self.models[city]
+            version, models = self.loadVersion(city)
+
+            with self.lock:
+                self.models[city] = (version, models)
+                self.models.move_to_end(city)
+                while len(self.models) > self.maxsize:
+                    model_version.remove(city=self.models.popitem(last=False)[0])
+
+        return version, models
+
+    def loadVersion(self, city):
+        """
+            Loads the models of a city and returns them with their version.
+        """
+        version = self.version(city)
+        with model_load_seconds.time(city=city):
+            models = self.load(os.path.join(self.path, city)+'/')
+        model_version.set(version/1e9, city=city)
+
+        return version, models
+
+    def refresh(self):
+        """
+            Reloads the loaded cities whose models have a new version.
+          The previous models are kept if the new ones cannot be loaded.
+        """
+        with self.lock:
+            loaded = [(city, version) for city, (version, _) in self.models.items()]
+
+        for city, version in loaded:
+            try:
+                if self.version(city) == version:
+                    continue
+                new_version, models = self.loadVersion(city)
+            except Exception:
+                logger.exception("Cannot reload the models of %s", city)
+                continue
+
+            with self.lock:
+                # Unless it has been unloaded meanwhile
+                if city in self.models:
+                    self.models[city] = (new_version, models)
+            logger.info("Reloaded the models of %s", city)
+
+    def preload(self, cities):
+        """
+            Loads the models of the given cities in advance.
+        """
+        for city in cities:
+            try:
+                self.get(city)
+            except KeyError:
+                logger.warning("There are no models for %s", city)
+
+    def watch(self, interval):
+        """
+            Starts a background thread that looks for new versions of
+          the loaded models every 'interval' seconds.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+
+        def start():
+            Thread(target=run, name='ModelRegistry', daemon=True).start()
+
+        def restart():
+            # The locks may have been held by the threads of the parent
+            self.lock = Lock()
+            self.loading = {}
+            start()
+
+        start()
+
+        # Threads do not survive a fork, so every worker of a preforking
+        # server (e.g. gunicorn with preload_app) starts its own thread
+        os.register_at_fork(after_in_child=restart)
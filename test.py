@@ -1,7 +1,27 @@
 import unittest
 import sys
+import os
+import asyncio
+import inspect
+import unittest.mock
+import time
+import tempfile
+from threading import Thread
+from datetime import datetime, timedelta, timezone
+import numpy as np
 import APIv1
 import APIv2
+import metrics
+from registry import ModelRegistry
+from predictor import ARIMAPredictor, loadPredictor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AirFlow'))
+
+def cacheLookups():
+    """
+        Returns the misses and hits of the forecast cache.
+    """
+    return tuple(metrics.cache_requests.values.get(('forecast', result), 0) for result in ['miss', 'hit'])
+
 
 class TestAPI(unittest.TestCase):
     VERSION = 'v1'
@@ -22,15 +42,473 @@ class TestAPI(unittest.TestCase):
             self.assertEqual(result.status_code, 200)
             self.assertEqual(result.content_type, "application/json")
 
+    def test_forecast_slices(self):
+        result_24 = self.app.get('/servicio/' + self.VERSION + '/prediccion/24horas').get_json()
+        result_72 = self.app.get('/servicio/' + self.VERSION + '/prediccion/72horas').get_json()
+        self.assertEqual(len(result_24), 24)
+        self.assertEqual(len(result_72), 72)
+        self.assertEqual(result_24, result_72[:24])
+
+    def test_cities(self):
+        result = self.app.get('/servicio/' + self.VERSION + '/ciudades')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('san_francisco', result.get_json())
+
+    def test_city_forecast(self):
+        result = self.app.get('/servicio/' + self.VERSION + '/san_francisco/prediccion/24horas')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json(),
+                         self.app.get('/servicio/' + self.VERSION + '/prediccion/24horas').get_json())
+
+    def test_unknown_city(self):
+        result = self.app.get('/servicio/' + self.VERSION + '/atlantis/prediccion/24horas')
+        self.assertEqual(result.status_code, 404)
+        result = self.app.get('/servicio/' + self.VERSION + '/../prediccion/24horas')
+        self.assertEqual(result.status_code, 404)
+
+    def test_forecast_hours(self):
+        result = self.app.get('/servicio/' + self.VERSION + '/prediccion?horas=6')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json(),
+                         self.app.get('/servicio/' + self.VERSION + '/prediccion/24horas').get_json()[:6])
+
+    def test_forecast_range(self):
+        forecast = self.app.get('/servicio/' + self.VERSION + '/prediccion/72horas').get_json()
+        start = datetime.strptime(forecast[10]['hour'], '%d/%m/%Y %H:%M')
+        end   = datetime.strptime(forecast[21]['hour'], '%d/%m/%Y %H:%M')
+        result = self.app.get('/servicio/' + self.VERSION + '/san_francisco/prediccion',
+                              query_string={'desde': start.isoformat(), 'hasta': end.isoformat()})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json(), forecast[10:22])
+
+    def test_forecast_time_zone(self):
+        forecast = self.app.get('/servicio/' + self.VERSION + '/prediccion/72horas').get_json()
+        start = datetime.strptime(forecast[10]['hour'], '%d/%m/%Y %H:%M').astimezone(timezone.utc)
+        end   = datetime.strptime(forecast[21]['hour'], '%d/%m/%Y %H:%M').astimezone(timezone(timedelta(hours=2)))
+        result = self.app.get('/servicio/' + self.VERSION + '/prediccion',
+                              query_string={'desde': start.strftime('%Y-%m-%dT%H:%MZ'), 'hasta': end.isoformat()})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json(), forecast[10:22])
+
+        result = self.app.post('/servicio/' + self.VERSION + '/prediccion/lote',
+                               json=[{'desde': start.isoformat(), 'hasta': end.isoformat()},
+                                     {'desde': [2026]}, {'horas': 6}])
+        self.assertEqual(result.status_code, 200)
+        range_forecast, wrong_date, forecast_6 = result.get_json()
+        self.assertEqual(range_forecast, forecast[10:22])
+        self.assertIn('error', wrong_date)
+        self.assertEqual(forecast_6, forecast[:6])
+
+    def test_no_forecast_hours(self):
+        for query in ['horas=0', 'horas=73', 'horas=abc', 'desde=2000-01-01&hasta=2000-01-02', 'desde=abc']:
+            result = self.app.get('/servicio/' + self.VERSION + '/prediccion?' + query)
+            self.assertEqual(result.status_code, 400)
+
+    def test_forecast_batch(self):
+        result = self.app.post('/servicio/' + self.VERSION + '/prediccion/lote',
+                               json=[{'horas': 24}, {'ciudad': 'san_francisco', 'horas': 6},
+                                     {'ciudad': 'atlantis', 'horas': 6}, {'horas': 100}])
+        self.assertEqual(result.status_code, 200)
+        forecast_24, forecast_6, unknown_city, no_forecast = result.get_json()
+        self.assertEqual(forecast_24,
+                         self.app.get('/servicio/' + self.VERSION + '/prediccion/24horas').get_json())
+        self.assertEqual(forecast_6, forecast_24[:6])
+        self.assertIn('error', unknown_city)
+        self.assertIn('error', no_forecast)
+
+    def test_no_forecast_batch(self):
+        for body in ['{', '{"horas": 24}', '[24]']:
+            result = self.app.post('/servicio/' + self.VERSION + '/prediccion/lote', data=body)
+            self.assertEqual(result.status_code, 400)
+
+    def test_forecast_formats(self):
+        url = '/servicio/' + self.VERSION + '/prediccion/24horas'
+        forecast = self.app.get(url).get_json()
+        columns = self.app.get(url, headers={'Accept': 'application/vnd.columns+json'})
+        self.assertEqual(columns.content_type, 'application/vnd.columns+json')
+        self.assertEqual(columns.get_json(force=True),
+                         {'hour': [hour['hour'] for hour in forecast],
+                          'temp': [hour['temp'] for hour in forecast],
+                          'hum' : [hour['hum'] for hour in forecast]})
+
+    def test_forecast_etag(self):
+        url = '/servicio/' + self.VERSION + '/prediccion/24horas'
+        result = self.app.get(url)
+        self.assertIsNotNone(result.headers.get('ETag'))
+        self.assertIn('max-age', result.headers.get('Cache-Control'))
+        result = self.app.get(url, headers={'If-None-Match': result.headers['ETag']})
+        self.assertEqual(result.status_code, 304)
+
     def test_no_forecast(self):
         result = self.app.get('/servicio/' + self.VERSION + '/prediccion/86horas')
         self.assertEqual(result.status_code, 400)
 
+    def test_metrics(self):
+        self.app.get('/servicio/' + self.VERSION + '/prediccion/24horas')
+        result = self.app.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'text/plain')
+        metrics = result.get_data(as_text=True)
+        self.assertIn('http_requests_total{route="/servicio/' + self.VERSION + '/prediccion/<int:interval>horas",'
+                      'method="GET",status="200"}', metrics)
+        self.assertIn('forecast_stage_duration_seconds_count{stage="predict"}', metrics)
+        self.assertIn('forecast_cache_requests_total{cache="forecast",result="hit"}', metrics)
+        self.assertIn('model_version{city="san_francisco"}', metrics)
+
+    def test_cache_metrics(self):
+        (APIv1 if self.VERSION == 'v1' else APIv2).forecasts.forecasts.clear()
+
+        # A lookup per request: the first one computes the forecast
+        for path, lookups in [('/prediccion/24horas', (1, 0)), ('/prediccion/24horas', (0, 1)),
+                              ('/prediccion?horas=6', (0, 1))]:
+            before = cacheLookups()
+            self.app.get('/servicio/' + self.VERSION + path)
+            self.assertEqual(tuple(np.subtract(cacheLookups(), before)), lookups)
+
     def test_wrong_url(self):
         result = self.app.get('/wrong_url')
         self.assertEqual(result.status_code, 404)
 
 
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for city in ['a', 'b', 'c']:
+            os.mkdir(os.path.join(self.path, city))
+        self.loaded = []
+        self.registry = ModelRegistry(self.path, self.load, maxsize=2)
+
+    def load(self, path):
+        self.loaded.append(os.path.basename(path.rstrip('/')))
+        return object()
+
+    def test_lazy_loading(self):
+        self.assertEqual(self.registry.cities(), ['a', 'b', 'c'])
+        self.assertEqual(self.loaded, [])
+        self.assertIs(self.registry.get('a'), self.registry.get('a'))
+        self.assertEqual(self.loaded, ['a'])
+
+    def test_lru_bound(self):
+        for city in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.registry.get(city)
+        self.assertEqual(self.loaded, ['a', 'b', 'c', 'b'])
+        self.assertEqual(list(self.registry.models), ['a', 'b'])
+
+    def test_reload(self):
+        models = self.registry.get('a')
+        self.registry.refresh()
+        self.assertIs(self.registry.get('a'), models)
+
+        with open(os.path.join(self.path, 'a', 'manifest.json'), 'w') as manifest:
+            manifest.write('{}')
+        self.registry.refresh()
+        self.assertIsNot(self.registry.get('a'), models)
+        self.assertEqual(self.loaded, ['a', 'a'])
+
+    def test_concurrent_loading(self):
+        load = self.registry.load
+        def slowLoad(path):
+            time.sleep(0.1)
+            return load(path)
+        self.registry.load = slowLoad
+
+        threads = [Thread(target=self.registry.get, args=(city,)) for city in ['a', 'a', 'a', 'b']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(self.loaded), ['a', 'b'])
+
+    def test_unknown_city(self):
+        self.assertRaises(KeyError, self.registry.get, 'd')
+        self.assertRaises(KeyError, self.registry.get, '..')
+
+
+class TestForecastOrigin(unittest.TestCase):
+    class Model:
+        def __init__(self, origin):
+            self.origin_ = origin
+
+        def predict(self, n_periods):
+            # Hours since the origin
+            return list(range(1, n_periods+1))
+
+    def test_origin(self):
+        origin = APIv1.pd.Timestamp('2013-02-03 11:00')
+        dates = APIv1.pd.date_range('2013-02-04 00:00', periods=24, freq='60min')
+        forecast_temp, forecast_hum = APIv1.predict((self.Model(origin), self.Model(origin)), dates)
+        self.assertEqual(list(forecast_temp), list(range(13, 37)))
+        self.assertEqual(list(forecast_hum), list(range(13, 37)))
+
+    def test_no_origin(self):
+        dates = APIv1.pd.date_range('2013-02-04 00:00', periods=24, freq='60min')
+        forecast_temp, _ = APIv1.predict((self.Model(None), self.Model(None)), dates)
+        self.assertEqual(list(forecast_temp), list(range(1, 25)))
+
+    def test_distant_origin(self):
+        random = np.random.default_rng(0)
+        transition = np.array([[0.9, 1.0], [-0.2, 0.0]])
+        model = ARIMAPredictor(random.normal(size=2), 15, transition, random.normal(size=2),
+                               random.normal(size=2), origin=APIv1.pd.Timestamp('2013-02-03 11:00'))
+        dates = APIv1.pd.date_range('2023-02-04 00:00', periods=24, freq='60min')
+        skip = int((dates[0] - model.origin_) / APIv1.pd.Timedelta(hours=1)) - 1
+
+        forecast_temp, _ = APIv1.predict((model, model), dates)
+        np.testing.assert_allclose(forecast_temp, model.predict(n_periods=skip+24)[skip:])
+
+        # Models that must predict every hour in between are rejected
+        self.assertRaises(APIv1.ForecastError, APIv1.predict,
+                          (self.Model(model.origin_), self.Model(model.origin_)), dates)
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        random = np.random.default_rng(0)
+        hours = np.arange(500)
+        self.y = 20 + 5*np.sin(2*np.pi*hours/24) + np.cumsum(random.normal(0, 0.1, 500))
+        self.X = np.column_stack((np.full(500, 2013), 1 + hours//(24*31), 1 + (hours//24) % 28, hours % 24))
+
+    def export(self, model):
+        from utils import exportModel, storeArrays
+        folder = os.path.join(tempfile.mkdtemp(), 'model')
+        storeArrays(folder, exportModel(model))
+        return loadPredictor(folder)
+
+    def test_arima(self):
+        import pmdarima
+        for order in [(0, 0, 0), (2, 1, 1), (1, 2, 1)]:
+            model = pmdarima.ARIMA(order=order, suppress_warnings=True).fit(self.y)
+            model.update(self.y[:24])
+            predictor = self.export(model)
+            self.assertIsInstance(predictor.transition, np.memmap)
+            self.assertTrue(np.allclose(predictor.predict(n_periods=100),
+                                        model.predict(n_periods=100)))
+
+    def test_forest(self):
+        from sklearn.ensemble import RandomForestRegressor
+        Y = np.column_stack((self.y, -self.y))
+        for targets in [self.y, Y]:
+            model = RandomForestRegressor(n_estimators=10, max_depth=50, random_state=0).fit(self.X, targets)
+            self.assertTrue(np.allclose(self.export(model).predict(self.X[::7]),
+                                        model.predict(self.X[::7])))
+
+
+class TestWorkflow(unittest.TestCase):
+    """
+        Workflow tasks with an in-process MongoDB (mongomock) and
+      synthetic datasets (see benchmark.py).
+    """
+    def setUp(self):
+        import mongomock
+        import mongomock.collection
+        import mongo
+        from benchmark import syntheticData
+
+        self.path = tempfile.mkdtemp()
+        self.hum_file = os.path.join(self.path, 'humidity.csv')
+        self.temp_file = os.path.join(self.path, 'temperature.csv')
+        self.city = syntheticData(self.path, 600, 1)[0]
+
+        self.client = mongomock.MongoClient()
+        patch = unittest.mock.patch.object
+        patches = [patch(mongo, 'MongoClient', lambda *args, **kwargs: self.client)]
+        # pymongo 4.11+ passes 'sort' to the updates of the bulk writes (not supported by mongomock)
+        builder = mongomock.collection.BulkOperationBuilder
+        for method in ['add_update', 'add_replace']:
+            if 'sort' not in inspect.signature(getattr(builder, method)).parameters:
+                original = getattr(builder, method)
+                patches.append(patch(builder, method,
+                                     lambda self, *args, sort=None, original=original, **kwargs:
+                                         original(self, *args, **kwargs)))
+        for mock in patches:
+            mock.start()
+            self.addCleanup(mock.stop)
+        mongo.resetClient()
+        self.addCleanup(mongo.resetClient)
+        self.database = self.client[mongo.MONGO_DATABASE]
+
+        import utils
+        self.utils = utils
+
+
+class TestIngestion(TestWorkflow):
+    def setUp(self):
+        super().setUp()
+        self.utils.mergeDataSets(self.hum_file, self.temp_file)
+        self.dataset = self.utils.loadDataSet(city=self.city)
+        self.client.drop_database(self.database.name)
+
+    def assertDataSet(self):
+        data = self.utils.loadDataSet(city=self.city)
+        self.assertTrue(data['DATE'].is_monotonic_increasing)
+        self.assertTrue(data.reset_index(drop=True).equals(self.dataset.reset_index(drop=True)))
+
+    def partialFiles(self, rows):
+        import pandas as pd
+        files = []
+        for filename in [self.hum_file, self.temp_file]:
+            files.append(filename + '.part')
+            pd.read_csv(filename, nrows=rows).to_csv(files[-1], index=False)
+        return files
+
+    def test_incremental_rerun(self):
+        for chunksize in [None, 100]:
+            self.client.drop_database(self.database.name)
+            self.utils.mergeDataSets(self.hum_file, self.temp_file, chunksize=chunksize, incremental=True)
+            self.assertEqual(self.utils.mergeDataSets(self.hum_file, self.temp_file, chunksize=chunksize,
+                                                      incremental=True), 0)
+            self.assertDataSet()
+
+    def test_incremental_resume(self):
+        for chunksize in [None, 100]:
+            # New rows of the same days (the last one incomplete)
+            self.client.drop_database(self.database.name)
+            self.utils.mergeDataSets(*self.partialFiles(310), chunksize=chunksize, incremental=True)
+            self.utils.mergeDataSets(self.hum_file, self.temp_file, chunksize=chunksize, incremental=True)
+            self.assertDataSet()
+
+            # Lost high-water mark
+            self.database.high_water_marks.delete_many({})
+            self.utils.mergeDataSets(self.hum_file, self.temp_file, chunksize=chunksize, incremental=True)
+            self.assertDataSet()
+
+    def test_failed_ingestion(self):
+        storeBuckets, calls = self.utils.storeBuckets, []
+        def failedStore(*args):
+            calls.append(args)
+            if len(calls) > 2:
+                raise RuntimeError('failed')
+            return storeBuckets(*args)
+
+        with unittest.mock.patch.object(self.utils, 'storeBuckets', failedStore):
+            self.assertRaises(RuntimeError, self.utils.mergeDataSets, self.hum_file, self.temp_file,
+                              chunksize=100, incremental=True)
+        # The batches stored before the failure are not stored again
+        self.assertIsNotNone(self.utils.getHighWaterMark('ingest'))
+        self.utils.mergeDataSets(self.hum_file, self.temp_file, chunksize=100, incremental=True)
+        self.assertDataSet()
+
+
+class TestTraining(TestWorkflow):
+    def test_update_random_forest(self):
+        utils = self.utils
+        utils.mergeDataSets(self.hum_file, self.temp_file)
+        dates = utils.loadDataSet(city=self.city)['DATE']
+        city_path = os.path.join(self.path, 'models', self.city) + '/'
+
+        def trees():
+            return len(utils.joblib.load(city_path + 'rf_temp_hum.joblib').estimators_)
+
+        utils.trainRandomForest(self.path + '/models/', multioutput=True, end=dates.iloc[500], cities=[self.city])
+        self.assertEqual(trees(), 100)
+
+        # Too few new rows: they wait for the next update
+        self.assertEqual(utils.updateRandomForest(self.path + '/models/', self.city, True, end=dates.iloc[510]), 0)
+        self.assertEqual(utils.getHighWaterMark('rf', self.city), dates.iloc[500])
+        self.assertEqual(utils.updateRandomForest(self.path + '/models/', self.city, True, end=dates.iloc[550]), 50)
+        self.assertEqual(trees(), 110)
+
+        # The forests are trained from scratch instead of growing without limit
+        self.assertIsNone(utils.updateRandomForest(self.path + '/models/', self.city, True,
+                                                   max_estimators=115))
+        utils.trainRandomForest(self.path + '/models/', multioutput=True, cities=[self.city], incremental=True)
+        self.assertEqual(trees(), 120)
+
+
+    def test_arima_hours(self):
+        import pandas as pd
+        utils = self.utils
+        utils.mergeDataSets(self.hum_file, self.temp_file)
+        dates = utils.loadDataSet(city=self.city)['DATE']
+        hour = pd.Timedelta(hours=1)
+
+        # The missing hours of the window are interpolated
+        data, last_date = utils.trainingData(end=dates.iloc[400], city=self.city, window=300)
+        self.assertEqual(len(data), 300)
+        self.assertLess(len(utils.loadDataSet(data['DATE'].iloc[0], last_date, city=self.city)), 300)
+        self.assertTrue((data['DATE'].diff().iloc[1:] == hour).all())
+        self.assertFalse(data.isna().any().any())
+
+        # The models take a step per hour since the last training
+        utils.trainARIMA(self.path + '/models/', end=dates.iloc[400], cities=[self.city], trace=False, window=100)
+        utils.trainARIMA(self.path + '/models/', cities=[self.city], trace=False, incremental=True)
+        model = utils.joblib.load(os.path.join(self.path, 'models', self.city, 'arima_humidity.joblib'))
+        self.assertEqual(model.origin_, dates.iloc[-1])
+        self.assertEqual(model.arima_res_.nobs, 100 + (dates.iloc[-1] - dates.iloc[400]) // hour)
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        os.environ['VERSION'] = TestAPI.VERSION
+        import asgi
+        self.asgi = asgi
+
+    async def request(self, path, query_string=b''):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string,
+                 'headers': [], 'http_version': '1.1'}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.asgi.app(scope, receive, send)
+        return messages[0]['status'], messages[1]['body']
+
+    def test_coalesced_forecast(self):
+        forecasts = self.asgi.api.forecasts
+        predict, calls = forecasts.predict, []
+        forecasts.predict = lambda *args: calls.append(args) or predict(*args)
+        forecasts.forecasts.clear()
+        lookups = cacheLookups()
+
+        async def requests():
+            return await asyncio.gather(*[self.request('/servicio/' + TestAPI.VERSION + '/prediccion/' + interval + 'horas')
+                                          for interval in ['24', '48', '72']*10])
+        try:
+            results = asyncio.run(requests())
+        finally:
+            forecasts.predict = predict
+
+        self.assertEqual([status for status, _ in results], [200]*30)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(tuple(np.subtract(cacheLookups(), lookups)), (1, 29))
+
+    def test_unknown_city(self):
+        status, _ = asyncio.run(self.request('/servicio/' + TestAPI.VERSION + '/atlantis/prediccion/24horas'))
+        self.assertEqual(status, 404)
+
+    def test_failed_forecast(self):
+        models = self.asgi.api.models
+        def failedLoad(path):
+            time.sleep(0.3)
+            raise FileNotFoundError(path)
+        load, models.load = models.load, failedLoad
+        saved = dict(models.models)
+        models.models.clear()
+
+        async def requests():
+            ticks = []
+            async def tick():
+                # The event loop keeps running while the models are loaded
+                for _ in range(10):
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.05)
+                    ticks.append(time.perf_counter() - start)
+            _, (status, _) = await asyncio.gather(tick(), self.request('/servicio/' + TestAPI.VERSION + '/prediccion/24horas'))
+            return status, ticks
+        try:
+            status, ticks = asyncio.run(requests())
+        finally:
+            models.load = load
+            models.models.update(saved)
+
+        self.assertEqual(status, 500)
+        self.assertLess(max(ticks), 0.25)
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         TestAPI.VERSION = sys.argv.pop()